@@ -1,5 +1,6 @@
 import mdtraj as md
 import numpy  as np
+from itertools import zip_longest
 
 def RMSD1to1(traj1,traj2):
     """
@@ -10,6 +11,8 @@ def RMSD1to1(traj1,traj2):
     traj2 is a reference trajectory.
     The function returns 1D numpy array, which contains
     one real rmsd value for each frame
+
+    All pairs are computed at once by paired_rmsd.
     """
 
     traj1_nframes = traj1.n_frames
@@ -19,13 +22,71 @@ def RMSD1to1(traj1,traj2):
     if traj1_nframes != traj2_nframes:
         raise IOError("Input trajectories contain different number of frames")
 
-    rmsd = np.empty(traj1_nframes)
-    for i in range(0,traj1_nframes):
-        rmsd[i]=md.rmsd(traj2[i],traj1[i])
+    rmsd = paired_rmsd(traj1.xyz, traj2.xyz)
     return(rmsd)
 
 
 
+def paired_rmsd(xyz1, xyz2):
+    """
+    The function calculates rmsd after optimal superposition for each pair of frames
+    xyz1[i], xyz2[i] in one vectorized pass (QCP method, Theobald 2005, the same as md.rmsd).
+    Coordinates are centered, and for each pair the largest eigenvalue of the 4x4 key matrix,
+    built from the inner product matrix of the pair, is found by a batched eigvalsh.
+
+    Args:
+        xyz1, xyz2 : numpy arrays with shape (n_frames, n_atoms, 3)
+
+    Returns:
+        1D numpy array with rmsd of each pair of frames
+    """
+    xyz1 = np.asarray(xyz1, dtype=np.float64)
+    xyz2 = np.asarray(xyz2, dtype=np.float64)
+    xyz1 = xyz1 - np.mean(xyz1, axis=1, keepdims=True)
+    xyz2 = xyz2 - np.mean(xyz2, axis=1, keepdims=True)
+    G = np.einsum('fai,fai->f', xyz1, xyz1) + np.einsum('fai,fai->f', xyz2, xyz2)
+    S = np.einsum('fai,faj->fij', xyz1, xyz2)
+    Sxx, Sxy, Sxz = S[:, 0, 0], S[:, 0, 1], S[:, 0, 2]
+    Syx, Syy, Syz = S[:, 1, 0], S[:, 1, 1], S[:, 1, 2]
+    Szx, Szy, Szz = S[:, 2, 0], S[:, 2, 1], S[:, 2, 2]
+    K = np.stack((np.stack((Sxx+Syy+Szz, Syz-Szy, Szx-Sxz, Sxy-Syx), axis=-1),
+                  np.stack((Syz-Szy, Sxx-Syy-Szz, Sxy+Syx, Szx+Sxz), axis=-1),
+                  np.stack((Szx-Sxz, Sxy+Syx, -Sxx+Syy-Szz, Syz+Szy), axis=-1),
+                  np.stack((Sxy-Syx, Szx+Sxz, Syz+Szy, -Sxx-Syy+Szz), axis=-1)), axis=1)
+    max_eigenvalue = np.linalg.eigvalsh(K)[:, -1]
+    return np.sqrt(np.maximum(G - 2*max_eigenvalue, 0)/xyz1.shape[1])
+
+
+
+def RMSD1to1_large(traj1, traj2, top1, top2=None, chunk_size=5000, atom_indices1=None, atom_indices2=None):
+    """
+    Streaming version of RMSD1to1 for two trajectory files with the same number of frames,
+    e.g. a reconstructed trajectory and its source. Both files are read in lockstep chunks,
+    so neither is loaded in memory as a whole.
+
+    Args:
+        traj1, traj2  : trajectory files. traj1 is a trajectory for which rmsd is calculated,
+                        traj2 is a reference trajectory
+        top1, top2    : topology files (top2=None - the same as top1)
+        chunk_size    : number of frames, read at once from each file
+        atom_indices1, atom_indices2 : None (default - all atoms) or indexes of atoms, used
+                        for rmsd, in each trajectory. Selections should correspond to each other
+
+    Returns:
+        1D numpy array with rmsd value for each frame
+    """
+    if top2 is None:
+        top2 = top1
+    rmsd = []
+    for chunk1, chunk2 in zip_longest(md.iterload(traj1, chunk=chunk_size, top=top1, atom_indices=atom_indices1),
+                                      md.iterload(traj2, chunk=chunk_size, top=top2, atom_indices=atom_indices2)):
+        if chunk1 is None or chunk2 is None or chunk1.n_frames != chunk2.n_frames:
+            raise IOError("Input trajectories contain different number of frames")
+        rmsd.append(paired_rmsd(chunk1.xyz, chunk2.xyz))
+    return(np.concatenate(rmsd + [np.empty(0)]))
+
+
+
 def index2res(structure):
     """
     The function creates list of residues based on files with indexes, used to calculate
@@ -1,7 +1,18 @@
 import numpy as np
 import os
 import re
+import pickle
+import hashlib
+import functools
+import tempfile
+import multiprocessing
 import mdtraj as md
+from scipy import optimize
+try:
+    from . import superimpose as sup
+except ImportError:
+    # md_nmr2 is imported as a top-level module (e.g. by tests/test1/RDC.py)
+    import superimpose as sup
 
 ########################################################################################
 #
@@ -33,6 +44,156 @@ class Bond:
         print("atomname_i = ", self.atomname_j)
 
 
+############################################################################################
+RDC_LINE = re.compile(r'^\s*(?P<resid_i>[0-9]+)'
+                      r'\s*(?P<resname_i>[A-Z]{3})'
+                      r'\s*(?P<name_i>[A-Z\#]{1,4})'
+                      r'\s*(?P<resid_j>[0-9]+)'
+                      r'\s*(?P<resname_j>[A-Z]{3})'
+                      r'\s*(?P<name_j>[A-Z\#]{1,4})'
+                      r'\s*(?P<rdc>-?[0-9\.]+)')
+
+
+class RDCRestraintSet:
+    """
+    Experimental RDCs, parsed from the input file once, with atom indexes of all bonds
+    resolved for a given topology. Objects are picklable and can be passed to all
+    calculate_rdc* functions instead of RDC_inp_file.
+
+    Args:
+        RDC_inp_file : file with experimental RDC values, see calculate_rdc
+        topology     : MDtraj topology or topology file
+        amide        : If False (default), bond_selections contain indexes of the two
+                       atoms of each bond. If True, only N-H bonds are allowed and
+                       bond_selections contain indexes of C(i-1), N(i) and CA(i),
+                       so that hydrogen-free trajectories can be used.
+
+    Attributes:
+        bonds           : list of Bond objects
+        RDCs            : numpy array with experimental RDCs
+        bond_selections : integer numpy array with shape (n_bonds, 2) or (n_bonds, 3)
+        amide           : see Args
+    """
+
+    def __init__(self, RDC_inp_file, topology, amide=False):
+        if isinstance(topology, str):
+            topology = md.load_topology(topology)
+        self.amide = amide
+        self.bonds = []
+        RDCs = []
+        with open(RDC_inp_file, 'r') as RDC_input:
+            for line in RDC_input:
+                match = RDC_LINE.search(line)
+                if match is None:
+                    continue
+                fields = line.split()
+                RDCs.append(float(fields[6]))  # Work only when RDC are in the 7 coulumn!
+                self.bonds.append(Bond(int(fields[0]), fields[1], fields[2],
+                                       int(fields[3]), fields[4], fields[5]))
+        self.RDCs = np.array(RDCs)
+
+        # Lookup table (residue index, atom name) -> atom index, built in a single pass over
+        # topology. The first atom is kept, the same as selection[0] of top.select
+        atom_table = {}
+        for atom in topology.atoms:
+            atom_table.setdefault((atom.residue.index, atom.name), atom.index)
+
+        # -1 correspond to transition between PDB numeration and MDTRAJ numeration
+        # Names of atoms in input files should be the same as one used by mdtraj
+        if amide:
+            for bond in self.bonds:
+                assert 'N' in (bond.atomname_i, bond.atomname_j), "Should have atom N in the bond"
+                assert 'H' in (bond.atomname_i, bond.atomname_j), "Should have atom H  in the bond"
+                assert bond.resid_i == bond.resid_j, "Atoms in a bond should belong to the same residue"
+                assert bond.resname_i == bond.resname_j, "Atoms in a bond should belong to the same residue"
+                assert bond.resid_i != 1, "RDC calculation for the first residue is not implemented yet. Use trajectory with hydrogens"
+            keys = [[(bond.resid_i-2, 'C'), (bond.resid_j-1, 'N'), (bond.resid_j-1, 'CA')]
+                    for bond in self.bonds]
+        else:
+            keys = [[(bond.resid_i-1, bond.atomname_i), (bond.resid_j-1, bond.atomname_j)]
+                    for bond in self.bonds]
+        for bond_keys in keys:
+            for key in bond_keys:
+                assert key in atom_table, "Atom %s of residue %i is not found in topology" % (key[1], key[0]+1)
+        self.bond_selections = np.array([[atom_table[key] for key in bond_keys] for bond_keys in keys],
+                                        dtype=int).reshape(len(keys), 3 if amide else 2)
+
+    def __len__(self):
+        return len(self.bonds)
+
+    @classmethod
+    def union(cls, restraint_sets):
+        """
+        Restraint set with unique bonds of several sets (e.g. of several alignment media),
+        so that bilinear terms of a bond shared by the sets are computed once. RDCs of the
+        union are nan.
+
+        Return:
+            union        - RDCRestraintSet
+            bond_indexes - list of integer arrays, bonds of each set in the union
+        """
+        all_selections = np.concatenate([restraints.bond_selections for restraints in restraint_sets])
+        bond_selections, first, inverse = np.unique(all_selections, axis=0, return_index=True,
+                                                    return_inverse=True)
+        inverse = inverse.ravel()
+        bounds = np.cumsum([0] + [len(restraints) for restraints in restraint_sets])
+        all_bonds = [bond for restraints in restraint_sets for bond in restraints.bonds]
+        union = cls.__new__(cls)
+        union.amide = restraint_sets[0].amide
+        union.bonds = [all_bonds[i] for i in first]
+        union.RDCs = np.full(len(bond_selections), np.nan)
+        union.bond_selections = bond_selections
+        return(union, [inverse[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])])
+
+
+############################################################################################
+def file_hash(filename):
+    """
+    Return sha1 hex digest of the content of a file
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def topology_hash(topology):
+    """
+    Return sha1 hex digest of a topology file or of atom and residue names of MDtraj topology
+    """
+    if isinstance(topology, str):
+        return file_hash(topology)
+    description = '\n'.join('%i %s %s' % (atom.residue.index, atom.residue.name, atom.name)
+                            for atom in topology.atoms)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def load_restraints(RDC_inp_file, topology, amide=False, cache_dir=None):
+    """
+    Return RDCRestraintSet for a given input file and topology.
+
+    If RDC_inp_file is already an RDCRestraintSet, it is returned as is.
+    If cache_dir is given, the restraint set is pickled to cache_dir, with the file name
+    based on hashes of topology and RDC_inp_file, and loaded from there next time.
+    """
+    if isinstance(RDC_inp_file, RDCRestraintSet):
+        assert RDC_inp_file.amide == amide, "Restraint set was created with amide=%s" % RDC_inp_file.amide
+        return RDC_inp_file
+    if cache_dir is None:
+        return RDCRestraintSet(RDC_inp_file, topology, amide=amide)
+
+    cache_file = os.path.join(cache_dir, 'rdc_restraints_%s_%s_%i.pkl' % (topology_hash(topology),
+                                                                         file_hash(RDC_inp_file),
+                                                                         amide))
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as cache:
+            return pickle.load(cache)
+    restraints = RDCRestraintSet(RDC_inp_file, topology, amide=amide)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file, 'wb') as cache:
+        pickle.dump(restraints, cache)
+    return restraints
 
 
 
@@ -99,21 +260,72 @@ def bilin_matrix(bond_selections, test_frame, noH=False):
 
 
     """
-    F = np.empty((len(bond_selections), 5))
-    i = 0
-    if noH == False:
-        for (pair) in bond_selections:
-            vec = vector(pair, test_frame)
-            bil = bilin(vec)
-            F[i, :] = bil
-            i += 1
+    F = bilin_matrix_chunk(bond_selections, test_frame.xyz[:1], noH=noH)
+    return F[0]
+
+#####################################################################################################
+def vector_chunk(atom_pairs, xyz):
+    """
+    Calculate normalized vectors for all pairs of atoms in a chunk of frames
+
+    Input:   atom_pairs - integer array with shape (n_bonds, 2)
+             xyz        - coordinates, numpy array with shape (n_frames, n_atoms, 3)
+
+    Output:  numpy array with shape (n_frames, n_bonds, 3)
+    """
+    atom_pairs = np.asarray(atom_pairs)
+    vec = np.subtract(xyz[:, atom_pairs[:, 1], :], xyz[:, atom_pairs[:, 0], :], dtype=np.float64)
+    vec /= np.linalg.norm(vec, axis=2, keepdims=True)
+    return vec
+
+#####################################################################################################
+def get_NH_vector_chunk(atoms, xyz):
+    """
+    Chunk version of get_NH_vector. Each row of atoms contains indexes of
+    C(i-1), N(i) and CA(i). Returns normalized NH vectors with shape (n_frames, n_bonds, 3)
+    """
+    atoms = np.asarray(atoms)
+    NH_vector = vector_chunk(atoms[:, [0, 1]], xyz) + vector_chunk(atoms[:, [2, 1]], xyz)
+    NH_vector /= np.linalg.norm(NH_vector, axis=2, keepdims=True)
+    return NH_vector
+
+#####################################################################################################
+def bilin_chunk(vectors):
+    """
+    Calculate bilinear components for an array of coordinate vectors.
+    Last axis of vectors should have length 3, the output has the same
+    leading axes and the last axis of length 5.
+    """
+    x = vectors[..., 0]
+    y = vectors[..., 1]
+    z = vectors[..., 2]
+    return np.stack((x*x - z*z,
+                     y*y - z*z,
+                     2*x*y,
+                     2*x*z,
+                     2*y*z), axis=-1)
+
+#####################################################################################################
+def bilin_matrix_chunk(bond_selections, xyz, noH=False):
+    """
+    Creates an array containing bilinear terms for all bonds in all frames of a chunk.
+
+    Input:   1) bond_selections
+                    Same as for bilin_matrix. If noH=True, each element contains
+                    indexes of C(i-1), N(i) and CA(i) atoms.
+
+             2) xyz
+                    numpy array with shape (n_frames, n_atoms, 3),
+                    for example, chunk.xyz of an MDtraj trajectory
+
+    Output:   F - numpy array with shape (n_frames, len(bond_selections), 5)
+              Includes bilinear components x^2-z^2, y^2-z^2, 2xy, 2xz, 2yz
+    """
     if noH:
-        for (pair) in bond_selections:
-            vec = get_NH_vector(pair, test_frame)
-            bil = bilin(vec)
-            F[i, :] = bil
-            i += 1
-    return F
+        vectors = get_NH_vector_chunk(bond_selections, xyz)
+    else:
+        vectors = vector_chunk(bond_selections, xyz)
+    return bilin_chunk(vectors)
 
 #####################################################################################################
 def get_NH_vector(atoms, frame):
@@ -126,9 +338,886 @@ def get_NH_vector(atoms, frame):
     NH_vector = normalize(NH_vector)
     return(NH_vector)
 #####################################################################################################
+def iterate_chunks(traj, topology, chunk_size=5000, start=0, stop=None):
+    """
+    Iterate over frames [start, stop) of a trajectory file in chunks of chunk_size frames.
+    stop=None means up to the end of the file. Yields MDtraj trajectories.
+    """
+    n_read = start
+    for chunk in md.iterload(traj, chunk=chunk_size, top=topology, skip=start):
+        if stop is not None and n_read + chunk.n_frames >= stop:
+            if stop > n_read:
+                yield chunk[:stop-n_read]
+            return
+        n_read += chunk.n_frames
+        yield chunk
+
+#####################################################################################################
+def count_frames(traj):
+    """
+    Return number of frames in a trajectory file without loading coordinates
+    """
+    with md.open(traj) as trajectory_file:
+        return len(trajectory_file)
+
+#####################################################################################################
+def load_frame(traj, topology, frame_index):
+    """
+    Load a single frame of a trajectory file, or of a list of files treated as one trajectory
+    """
+    if isinstance(traj, str):
+        traj = [traj]
+    for traj_file in traj:
+        n_frames = count_frames(traj_file)
+        if frame_index < n_frames:
+            return md.load_frame(traj_file, frame_index, top=topology)
+        frame_index -= n_frames
+    raise IndexError("Frame is beyond the end of trajectory")
+
+#####################################################################################################
+def trajectory_segments(traj, n_segments=1):
+    """
+    Split a trajectory file, or a list of trajectory files (replicas), into frame ranges.
+
+    Args:
+        traj       : trajectory file or list of trajectory files. An item of the list may also
+                     be a frame range (file, start, stop) of a file
+        n_segments : approximate number of segments. If it does not exceed the number of
+                     files, each file is a single segment and frames are not counted.
+
+    Return:
+        list of tuples (file, start, stop); stop=None means up to the end of the file
+    """
+    if isinstance(traj, str):
+        traj = [traj]
+    ranges = [(item, 0, None) if isinstance(item, str) else tuple(item) for item in traj]
+    if n_segments <= len(ranges):
+        return ranges
+
+    n_frames = [(count_frames(traj_file) if stop is None else stop) - start
+                for traj_file, start, stop in ranges]
+    total_frames = sum(n_frames)
+    segments = []
+    for (traj_file, first_frame, stop), n in zip(ranges, n_frames):
+        n_split = max(1, int(round(n_segments*n/total_frames)))
+        bounds = first_frame + np.linspace(0, n, n_split+1).astype(int)
+        segments += [(traj_file, int(start), int(stop))
+                     for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    return segments
+
+#####################################################################################################
+class ObservableAccumulator:
+    """
+    Running sums of per-frame observables over frames of a trajectory. Observables of a
+    frame are an array with shape (n_items, n_components), e.g. bilinear terms of bonds
+    (RDC, n_components=5), inverse distance powers of restraints (md_noe) or 3J couplings.
+
+    Besides the total sum, sums over consecutive blocks of block_size frames are kept
+    (if block_size is not None), so that block averages, bootstrap and convergence
+    estimates can be obtained later without reading the trajectory again.
+    Accumulators of different parts of a trajectory can be combined with merge.
+
+    Attributes:
+        sums         : numpy array (n_items, n_components), sum of (weighted) observables over all frames
+        n_of_frames  : number of accumulated frames
+        weight_sum   : sum of weights of accumulated frames (equal to n_of_frames, if frames
+                       are not weighted)
+        block_size   : number of frames in a block or None. May also be an increasing integer
+                       array of block edges (first frames of blocks, starting with 0), then
+                       frames [edges[k], edges[k+1]) form block k and frames after the last
+                       edge belong to the last block
+        block_sums   : dictionary {block index: sum of observables over the block}
+        block_frames : dictionary {block index: number of frames in the block
+                                                (sum of weights, if frames are weighted)}
+        n_states     : number of microstates or None. If given, sums over frames of each
+                       microstate are kept, labels of frames should be passed to add
+        state_sums   : numpy array (n_states, n_items, n_components), sums of observables over
+                       frames of each microstate
+        state_frames : numpy array, number of frames (sum of weights) in each microstate
+    """
+
+    def __init__(self, n_items, block_size=None, n_states=None, n_components=5):
+        self.n_components = n_components
+        self.sums = np.zeros((n_items, n_components))
+        self.n_of_frames = 0
+        self.weight_sum = 0
+        self.block_size = block_size
+        self.block_sums = {}
+        self.block_frames = {}
+        self.n_states = n_states
+        self.state_sums = None
+        self.state_frames = None
+        if n_states is not None:
+            self.state_sums = np.zeros((n_states, n_items, n_components))
+            self.state_frames = np.zeros(n_states)
+
+    def add(self, values, first_frame=0, weights=None, labels=None):
+        """
+        Add observables with shape (n_frames, n_items, n_components) of consecutive frames,
+        first_frame is the index of the first of them in the whole trajectory.
+        weights - None or numpy array with weight of each frame
+        labels  - None or integer numpy array with microstate of each frame (if n_states is given)
+        """
+        n_frames = values.shape[0]
+        if weights is None:
+            self.sums += np.sum(values, axis=0)
+            self.weight_sum += n_frames
+        else:
+            values = values*weights[:, None, None]
+            self.sums += np.sum(values, axis=0)
+            self.weight_sum += np.sum(weights)
+        self.n_of_frames += n_frames
+        if self.n_states is not None:
+            np.add.at(self.state_sums, labels, values)
+            np.add.at(self.state_frames, labels, 1 if weights is None else weights)
+        if self.block_size is None or n_frames == 0:
+            return
+        if np.ndim(self.block_size) == 0:
+            labels = (first_frame + np.arange(n_frames)) // self.block_size
+        else:
+            labels = np.searchsorted(self.block_size, first_frame + np.arange(n_frames), side='right') - 1
+        blocks, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+        sums = np.add.reduceat(values, starts, axis=0)
+        if weights is not None:
+            counts = np.add.reduceat(weights, starts)
+        for block, block_sum, n in zip(blocks, sums, counts):
+            self.add_block(int(block), block_sum, n)
+
+    def add_block(self, block, block_sum, n):
+        if block in self.block_sums:
+            self.block_sums[block] = self.block_sums[block] + block_sum
+            self.block_frames[block] += n
+        else:
+            self.block_sums[block] = block_sum
+            self.block_frames[block] = n
+
+    def merge(self, other):
+        """
+        Add sums of another accumulator to this one
+        """
+        self.sums += other.sums
+        self.n_of_frames += other.n_of_frames
+        self.weight_sum += other.weight_sum
+        if self.n_states is not None:
+            self.state_sums += other.state_sums
+            self.state_frames += other.state_frames
+        for block in other.block_sums:
+            self.add_block(block, other.block_sums[block], other.block_frames[block])
+
+    def average(self):
+        """
+        Return observables, (weighted) averaged over all frames
+        """
+        return np.divide(self.sums, self.weight_sum)
+
+    def blocks(self):
+        """
+        Return two numpy arrays, ordered by block index:
+            block_sums   - sums of observables with shape (n_blocks, n_items, n_components)
+            block_frames - numbers of frames in blocks (sums of weights)
+        """
+        order = sorted(self.block_sums)
+        block_sums = np.array([self.block_sums[block] for block in order]).reshape(len(order), -1,
+                                                                                    self.n_components)
+        block_frames = np.array([self.block_frames[block] for block in order])
+        return block_sums, block_frames
+
+
+# Name of the accumulator of bilinear matrices of RDCs (n_items - bonds, n_components=5)
+BilinAccumulator = ObservableAccumulator
+
+#####################################################################################################
+def accumulate_chunks(chunks, kernel, n_items, n_components=5, scratch=None, scratch_dtype=np.float32,
+                      block_size=None, frame_offset=0, reference=None, atom_indices=None,
+                      weights=None, labels=None, n_states=None):
+    """
+    Sum per-frame observables over chunks of a trajectory. This is the only chunk loop:
+    trajectory files (accumulate_observable) and in-memory trajectories (NMREngine) both
+    go through it, so that weights and microstate labels are checked in the same way.
+
+    Args:
+        chunks          : iterable over MDtraj trajectories (chunks of consecutive frames),
+                          e.g. iterate_chunks or NMREngine.frames
+        other arguments : see accumulate_observable
+
+    Return:
+        ObservableAccumulator
+    """
+    accumulator = ObservableAccumulator(n_items, block_size=block_size, n_states=n_states,
+                                        n_components=n_components)
+    for chunk in chunks:
+        if reference is not None:
+            chunk.superpose(reference, 0, atom_indices=atom_indices,
+                            ref_atom_indices=np.arange(reference.n_atoms))
+        values = kernel(chunk.xyz)
+        frames = slice(accumulator.n_of_frames, accumulator.n_of_frames+chunk.n_frames)
+        chunk_weights = None
+        if weights is not None:
+            chunk_weights = weights[frames]
+            if len(chunk_weights) != chunk.n_frames:
+                raise ValueError("Number of weights is smaller than number of frames")
+        chunk_labels = None
+        if labels is not None:
+            chunk_labels = labels[frames]
+            if len(chunk_labels) != chunk.n_frames:
+                raise ValueError("Number of microstate labels is smaller than number of frames")
+        accumulator.add(values, first_frame=frame_offset+accumulator.n_of_frames, weights=chunk_weights,
+                        labels=chunk_labels)
+        if scratch is not None:
+            values.astype(scratch_dtype).tofile(scratch)
+    return accumulator
+
+
+def check_frame_count(accumulator, weights=None, labels=None):
+    """
+    Raise ValueError, if the number of weights or microstate labels is not equal
+    to the number of frames, summed by accumulator
+    """
+    if weights is not None and len(weights) != accumulator.n_of_frames:
+        raise ValueError("Number of weights (%i) is not equal to number of frames (%i)"
+                         % (len(weights), accumulator.n_of_frames))
+    if labels is not None and len(labels) != accumulator.n_of_frames:
+        raise ValueError("Number of microstate labels (%i) is not equal to number of frames (%i)"
+                         % (len(labels), accumulator.n_of_frames))
+
+
+def accumulate_observable(traj, topology, kernel, n_items, n_components=5, chunk_size=5000,
+                          scratch=None, scratch_dtype=np.float32, start=0, stop=None,
+                          block_size=None, frame_offset=0, reference=None, atom_indices=None,
+                          weights=None, labels=None, n_states=None):
+    """
+    Sum per-frame observables over all frames of a trajectory file, reading it in chunks
+    (accumulate_chunks over iterate_chunks).
+
+    Args:
+        traj            : trajectory file in any format, supported by md_traj
+        topology        : topology file (the same as one for mdtraj)
+        kernel          : function kernel(xyz), which returns observables of all frames of
+                          a chunk (coordinates with shape (n_frames, n_atoms, 3)) as an array
+                          with shape (n_frames, n_items, n_components), e.g.
+                          functools.partial(bilin_matrix_chunk, bond_selections).
+                          It has to be picklable (a module level function or functools.partial
+                          of it) for worker processes of accumulate_observable_parallel
+        n_items         : number of items (bonds, restraints, ...), returned by kernel
+        n_components    : number of observables per item (5 for bilinear terms)
+        chunk_size      : number of frames, loaded in memory at once.
+                          Peak memory is proportional to chunk_size.
+        scratch         : binary file object or None (default). If given, observables
+                          of every frame are appended to it as raw scratch_dtype values,
+                          frame by frame, so that they can be memory-mapped later with
+                          shape (n_of_frames, n_items, n_components)
+        scratch_dtype   : numpy dtype of values written to scratch (default float32)
+        start, stop     : range of frames to process, see iterate_chunks
+        block_size      : see ObservableAccumulator
+        frame_offset    : index of frame start in the whole (multi-file) trajectory,
+                          used to assign frames to blocks
+        reference       : None (default) or single-frame MDtraj trajectory (e.g. of
+                          streaming_reference). If given, each chunk is superimposed on it
+                          by atoms atom_indices before observables are computed
+        atom_indices    : indexes of atoms in topology, used for superposition on reference
+                          (all atoms of reference, in the same order)
+        weights         : None (default) or numpy array with weights of frames start, start+1, ...
+        labels          : None (default) or integer numpy array with microstates of frames
+                          start, start+1, ...
+        n_states        : number of microstates, see ObservableAccumulator
+
+    Return:
+        ObservableAccumulator
+    """
+    return accumulate_chunks(iterate_chunks(traj, topology, chunk_size, start=start, stop=stop), kernel, n_items,
+                             n_components=n_components, scratch=scratch, scratch_dtype=scratch_dtype,
+                             block_size=block_size, frame_offset=frame_offset, reference=reference,
+                             atom_indices=atom_indices, weights=weights, labels=labels, n_states=n_states)
+
+
+def accumulate_bilin_matrix(traj, topology, bond_selections, noH=False, **kwargs):
+    """
+    Sum bilinear terms of bonds over all frames of a trajectory file, reading it in chunks:
+    accumulate_observable with bilin_matrix_chunk kernel (see it for bond_selections and noH).
+    Other keyword arguments - see accumulate_observable.
+
+    Return:
+        BilinAccumulator
+    """
+    return accumulate_observable(traj, topology, functools.partial(bilin_matrix_chunk, bond_selections, noH=noH),
+                                 len(bond_selections), n_components=5, **kwargs)
+
+#####################################################################################################
+def segment_offsets(segments):
+    """
+    Return index of the first frame of each segment (see trajectory_segments)
+    in the whole trajectory, formed by all segments one after another
+    """
+    offsets = []
+    offset = 0
+    for traj, start, stop in segments:
+        offsets.append(offset)
+        if stop is None:
+            stop = count_frames(traj)
+        offset += stop - start
+    return offsets
+
+#####################################################################################################
+def accumulate_observable_segment(task):
+    """
+    Worker function for accumulate_observable_parallel.
+    task is a dictionary with key 'segment' - tuple (file, start, stop), key 'scratch_file' -
+    file name or None, and other keyword arguments of accumulate_observable.
+    Returns ObservableAccumulator of the segment.
+    """
+    task = dict(task)
+    traj, start, stop = task.pop('segment')
+    scratch_file = task.pop('scratch_file')
+    if scratch_file is None:
+        return accumulate_observable(traj, start=start, stop=stop, **task)
+    with open(scratch_file, 'wb') as scratch:
+        return accumulate_observable(traj, start=start, stop=stop, scratch=scratch, **task)
+
+#####################################################################################################
+def accumulate_observable_parallel(traj, topology, kernel, n_items, n_components=5, chunk_size=5000, n_jobs=1,
+                                   scratch_dir=None, scratch_dtype=np.float32, block_size=None,
+                                   reference=None, atom_indices=None, frame_offset=0, weights=None,
+                                   labels=None, n_states=None):
+    """
+    Map-reduce version of accumulate_observable.
+
+    The trajectory file (or list of replica files) is split into frame ranges by
+    trajectory_segments. With n_jobs > 1 each segment is processed by a separate worker
+    process, that returns partial sums of observables and number of frames.
+    Partial sums are reduced in the order of segments, so the result is the same as
+    for n_jobs=1 up to the order of summation.
+
+    Args:
+        see accumulate_observable
+        n_jobs      : number of worker processes (default 1 - no worker processes)
+        scratch_dir : existing directory or None. If given, each segment spills observables
+                      of its frames to a separate file in scratch_dir
+        frame_offset: index of the first frame of traj in a longer trajectory (used for blocks)
+        weights     : None (default) or numpy array with weight of each frame of traj,
+                      see frame_weights
+        labels      : None (default) or integer numpy array with microstate of each frame of traj
+        n_states    : number of microstates, see ObservableAccumulator
+
+    Return:
+        accumulator   - ObservableAccumulator with sums over all frames
+        scratch_files - list of tuples (file, n_of_frames) in the order of frames,
+                        empty if scratch_dir is None
+    """
+    segments = trajectory_segments(traj, n_segments=n_jobs)
+    scratch_files = [None]*len(segments)
+    if scratch_dir is not None:
+        scratch_files = [os.path.join(scratch_dir, 'segment_%i.bilin' % i) for i in range(len(segments))]
+    offsets = [0]*len(segments)
+    if (block_size is not None or weights is not None or labels is not None) and len(segments) > 1:
+        offsets = segment_offsets(segments)
+    bounds = list(zip(offsets, offsets[1:] + [None]))
+    segment_weights = [None]*len(segments)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        segment_weights = [weights[start:stop] for start, stop in bounds]
+    segment_labels = [None]*len(segments)
+    if labels is not None:
+        labels = np.asarray(labels, dtype=int)
+        segment_labels = [labels[start:stop] for start, stop in bounds]
+    tasks = [dict(segment=segment, scratch_file=scratch_file, frame_offset=frame_offset+offset,
+                  topology=topology, kernel=kernel, n_items=n_items, n_components=n_components,
+                  chunk_size=chunk_size, scratch_dtype=scratch_dtype, block_size=block_size,
+                  reference=reference, atom_indices=atom_indices, weights=segment_weight,
+                  labels=segment_label, n_states=n_states)
+             for segment, scratch_file, offset, segment_weight, segment_label
+             in zip(segments, scratch_files, offsets, segment_weights, segment_labels)]
+
+    if n_jobs > 1:
+        with multiprocessing.Pool(min(n_jobs, len(tasks))) as pool:
+            results = pool.map(accumulate_observable_segment, tasks)
+    else:
+        results = [accumulate_observable_segment(task) for task in tasks]
+
+    accumulator = ObservableAccumulator(n_items, block_size=block_size, n_states=n_states,
+                                        n_components=n_components)
+    for segment_accumulator in results:
+        accumulator.merge(segment_accumulator)
+    check_frame_count(accumulator, weights, labels)
+    if scratch_dir is None:
+        return accumulator, []
+    return accumulator, [(scratch_file, segment_accumulator.n_of_frames)
+                         for scratch_file, segment_accumulator in zip(scratch_files, results)]
+
+
+def accumulate_bilin_parallel(traj, topology, bond_selections, noH=False, **kwargs):
+    """
+    Map-reduce sums of bilinear terms of bonds: accumulate_observable_parallel with
+    bilin_matrix_chunk kernel (see it for bond_selections and noH). Other keyword
+    arguments - see accumulate_observable_parallel. Scratch files contain bilinear
+    matrices with shape (n_of_frames, n_bonds, 5).
+
+    Return:
+        accumulator   - BilinAccumulator with sums over all frames
+        scratch_files - see accumulate_observable_parallel
+    """
+    return accumulate_observable_parallel(traj, topology, functools.partial(bilin_matrix_chunk, bond_selections,
+                                                                            noH=noH),
+                                          len(bond_selections), n_components=5, **kwargs)
+
+#####################################################################################################
+def frame_weights(weights, dtrajs=None):
+    """
+    Return numpy array with weight of each frame of a trajectory.
+
+    Args:
+        weights : numpy array or name of a text file with weights.
+                  If dtrajs is None, these are weights of frames (e.g. reweighting factors).
+                  Otherwise, these are probabilities of microstates (e.g. MSM stationary
+                  distribution), indexed by microstate labels of dtrajs.
+        dtrajs  : None (default), 1D numpy array or name of a text file (e.g. dtrajs.txt),
+                  containing 0-based microstate label of each frame.
+
+    If dtrajs is given, weight of a frame in microstate s is pi[s]/N[s], where N[s] is
+    the number of frames in microstate s, so that the weighted average over frames
+    is the average over microstates with probabilities pi.
+    """
+    if isinstance(weights, str):
+        weights = np.loadtxt(weights)
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    if dtrajs is None:
+        return weights
+    if isinstance(dtrajs, str):
+        dtrajs = np.loadtxt(dtrajs, dtype=int)
+    dtrajs = np.asarray(dtrajs, dtype=int).ravel()
+    counts = np.bincount(dtrajs, minlength=len(weights))
+    return weights[dtrajs]/counts[dtrajs]
+
+#####################################################################################################
+def file_fingerprint(filename, head_size=1 << 20):
+    """
+    Return a cheap fingerprint of a (large) file: size, sha1 of its first head_size bytes
+    (default - 1 MB) and sha1 of its last megabyte (empty string for files smaller than 1 MB)
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as input_file:
+        head = hashlib.sha1(input_file.read(head_size)).hexdigest()
+        tail = ''
+        if size > 1 << 20:
+            input_file.seek(max(size - (1 << 20), 1 << 20))
+            tail = hashlib.sha1(input_file.read()).hexdigest()
+    return (size, head, tail)
+
+#####################################################################################################
+class AccumulatorState:
+    """
+    State of streaming accumulation, which can be saved to a small file and extended later
+    with new trajectory files (for example, new segments of a running simulation).
+
+    Attributes:
+        accumulator     : BilinAccumulator with sums over all processed frames
+        fingerprints    : dictionary {absolute path: file_fingerprint} of processed files
+        n_frames        : dictionary {absolute path: number of processed frames of the file}
+        bond_selections : bond selections, used for accumulation
+        noH             : see bilin_matrix_chunk
+        reference       : reference C-alpha frame for superposition or None
+        atom_indices    : indexes of atoms, used for superposition on reference
+    """
+
+    def __init__(self, bond_selections, noH=False, block_size=None):
+        self.bond_selections = np.array(bond_selections)
+        self.noH = noH
+        self.accumulator = BilinAccumulator(len(bond_selections), block_size=block_size)
+        self.fingerprints = {}
+        self.n_frames = {}
+        self.reference = None
+        self.atom_indices = None
+
+    @classmethod
+    def load(cls, state_file):
+        with open(state_file, 'rb') as state_input:
+            return pickle.load(state_input)
+
+    def save(self, state_file):
+        """
+        Save the state. A temporary file is renamed at the end, so an interrupted
+        run does not corrupt the previous state
+        """
+        with open(state_file + '.tmp', 'wb') as state_output:
+            pickle.dump(self, state_output)
+        os.replace(state_file + '.tmp', state_file)
+
+    def new_files(self, traj):
+        """
+        Return files from traj (file or list of files), which have not been processed yet or
+        have grown since then (e.g. a trajectory, extended by mdrun -append), as a list of
+        tuples (file, number of processed frames). Frames of a grown file are read from
+        the first frame, which has not been processed.
+        Raises ValueError if the beginning of a processed file has been changed.
+        """
+        if isinstance(traj, str):
+            traj = [traj]
+        new_files = []
+        for traj_file in traj:
+            path = os.path.abspath(traj_file)
+            if path not in self.fingerprints:
+                new_files.append((traj_file, 0))
+                continue
+            size, head, tail = self.fingerprints[path]
+            if file_fingerprint(traj_file) == (size, head, tail):
+                continue
+            # the beginning is compared over the same number of bytes as it was hashed
+            if file_fingerprint(traj_file, head_size=min(size, 1 << 20))[1] != head:
+                raise ValueError("File %s has changed since it was processed" % traj_file)
+            new_files.append((traj_file, self.n_frames[path]))
+        return new_files
+
+#####################################################################################################
+def accumulate_with_state(traj, topology, bond_selections, state_file, noH=False, chunk_size=5000,
+                          n_jobs=1, block_size=None, minimize_rmsd=False, n_reference_samples=1000,
+                          seed=0, weights=None):
+    """
+    Resumable version of accumulate_bilin_parallel. If state_file exists, accumulation
+    continues from the saved state and only files of traj, that have not been processed
+    before, are read. Files, which have grown since they were processed, are read from
+    the first new frame. The updated state is saved to state_file.
+
+    If minimize_rmsd=True, the reference frame is chosen (see streaming_reference) when the
+    state is created and is stored in it, so that all later segments are superimposed on
+    the same frame.
 
+    weights (if given) are weights of all frames in the order of processing, including
+    frames processed before.
 
-def calculate_rdc(traj_ref,RDC_inp_file,minimize_rmsd=True,superimpose=False,mode='average'):
+    Return:
+        BilinAccumulator with sums over all processed frames
+    """
+    if os.path.isfile(state_file):
+        state = AccumulatorState.load(state_file)
+        assert np.array_equal(state.bond_selections, bond_selections), "State file was created for other bonds"
+        assert state.noH == noH, "State file was created with noH=%s" % state.noH
+        assert state.accumulator.block_size == block_size, \
+            "State file was created with block_size=%s" % state.accumulator.block_size
+        assert (state.reference is not None) == minimize_rmsd, \
+            "State file was created with minimize_rmsd=%s" % (state.reference is not None)
+    else:
+        state = AccumulatorState(bond_selections, noH=noH, block_size=block_size)
+
+    new_files = state.new_files(traj)
+    if len(new_files) == 0:
+        return state.accumulator
+    # fingerprints are taken before counting frames: if a file grows in between,
+    # the next call finds it changed and reads the rest
+    fingerprints = [file_fingerprint(traj_file) for traj_file, n_done in new_files]
+    segments = [(traj_file, n_done, max(n_done, count_frames(traj_file))) for traj_file, n_done in new_files]
+    if weights is not None:
+        weights = np.asarray(weights)[state.accumulator.n_of_frames:]
+    if minimize_rmsd and state.reference is None:
+        state.reference, state.atom_indices, frame_index = streaming_reference([segment[0] for segment in segments],
+                                                                                topology,
+                                                                                n_samples=n_reference_samples,
+                                                                                chunk_size=chunk_size, seed=seed)
+    new_segments = [segment for segment in segments if segment[2] > segment[1]]
+    if len(new_segments) > 0:
+        accumulator, scratch_files = accumulate_bilin_parallel(new_segments, topology, bond_selections, noH=noH,
+                                                               chunk_size=chunk_size, n_jobs=n_jobs,
+                                                               block_size=block_size,
+                                                               reference=state.reference,
+                                                               atom_indices=state.atom_indices,
+                                                               frame_offset=state.accumulator.n_of_frames,
+                                                               weights=weights)
+        state.accumulator.merge(accumulator)
+    for (traj_file, n_done, n_frames), fingerprint in zip(segments, fingerprints):
+        state.fingerprints[os.path.abspath(traj_file)] = fingerprint
+        state.n_frames[os.path.abspath(traj_file)] = n_frames
+    state.save(state_file)
+    return state.accumulator
+
+#####################################################################################################
+def back_calculate_rdc(F_frames, A, out=None, chunk_size=5000, bond_index=None):
+    """
+    Back-calculate RDCs of every frame from per-frame bilinear matrices and
+    an alignment tensor.
+
+    Args:
+        F_frames    : numpy array (or memmap) with shape (n_frames, n_bonds, 5)
+        A           : alignment tensor, numpy array with length 5
+        out         : None (default) or preallocated array (or memmap) with shape
+                      (n_frames, n_bonds), where the result is written
+        chunk_size  : number of frames processed at once
+        bond_index  : None (default) or integer array. If given, only bonds
+                      F_frames[:, bond_index] are used
+
+    Return:
+        D - numpy array (or memmap) with shape (n_frames, n_bonds)
+    """
+    if bond_index is None:
+        bond_index = slice(None)
+    if out is None:
+        out = np.empty((F_frames.shape[0], F_frames[:1, bond_index].shape[1]))
+    for start in range(0, F_frames.shape[0], chunk_size):
+        out[start:start+chunk_size] = np.dot(F_frames[start:start+chunk_size][:, bond_index], A)
+    return out
+
+#####################################################################################################
+def back_calculate_scratch(scratch_files, n_bonds, A, bond_index=None, output_file=None,
+                           chunk_size=5000, scratch_dtype=np.float32):
+    """
+    Back-calculate RDCs of every frame from scratch files, written by accumulate_bilin_parallel.
+
+    Args:
+        scratch_files : list of tuples (file, n_of_frames), see accumulate_bilin_parallel
+        n_bonds       : number of bonds, stored in scratch files
+        A, bond_index : see back_calculate_rdc
+        output_file   : None (default) or name of .npy file, where the result is written as memmap
+        chunk_size    : number of frames processed at once
+        scratch_dtype : dtype of scratch files
+
+    Return:
+        D - numpy array (or memmap) with shape (n_frames, n_bonds)
+    """
+    n_of_frames = sum(n_segment for scratch_file, n_segment in scratch_files)
+    shape = (n_of_frames, n_bonds if bond_index is None else len(bond_index))
+    if output_file is None:
+        D = np.empty(shape)
+    else:
+        D = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float64, shape=shape)
+    offset = 0
+    for scratch_file, n_segment in scratch_files:
+        if n_segment == 0:
+            continue
+        F_frames = np.memmap(scratch_file, dtype=scratch_dtype, mode='r',
+                             shape=(n_segment, n_bonds, 5))
+        back_calculate_rdc(F_frames, A, out=D[offset:offset+n_segment], chunk_size=chunk_size,
+                           bond_index=bond_index)
+        del F_frames
+        offset += n_segment
+    return D
+
+#####################################################################################################
+def streaming_reference(traj, topology, n_samples=1000, chunk_size=5000, seed=0):
+    """
+    Find a reference frame for superposition of a trajectory, that cannot be loaded in memory.
+    C-alpha atoms of n_samples random frames (all frames, if the trajectory is not longer)
+    are collected in a single pass over the trajectory, and the frame, minimizing sum of
+    C-alpha RMSD with respect to all other sampled frames, is chosen. All atoms of the
+    frame are then read, so that chunks are superimposed on all atoms, as in calculate_rdc.
+
+    Return:
+        reference    - single-frame MDtraj trajectory with all atoms of the reference frame
+        atom_indices - indexes of atoms in topology, used for superposition (all atoms)
+        frame_index  - index of the reference frame in the trajectory
+    """
+    alpha_reference, frame_index = sup.reference_frame(traj, topology, n_samples=n_samples,
+                                                       chunk_size=chunk_size, seed=seed)
+    reference = load_frame(traj, topology, frame_index)
+    return reference, np.arange(reference.n_atoms), frame_index
+
+#####################################################################################################
+
+
+class NMREngine:
+    """
+    Engine for NMR observables of a trajectory. It owns the chunked frame reader, the
+    vectorized kernels (bilin_matrix_chunk, or any kernel of accumulate_observable), the
+    choice of the reference frame for superposition and the fitting of alignment tensors.
+    In-memory trajectories (MDtraj Trajectory) and trajectory files (or lists of replica
+    files) go through the same chunk loop (accumulate_chunks). calculate_rdc,
+    calculate_rdc_large*, calculate_j3 (and functions of md_nmr and md_noe) are thin
+    wrappers around it.
+
+    Args:
+        topology      : MDtraj topology or topology file
+        chunk_size    : number of frames processed at once (default 5000)
+        n_jobs        : number of worker processes for trajectory files (default 1)
+        scratch_dir   : directory for scratch files with per-frame bilinear matrices
+                        (default - system tmp)
+        scratch_dtype : dtype of scratch files (default float32)
+        cache_dir     : None (default) or directory, where parsed restraints are cached,
+                        see load_restraints
+        n_reference_samples : number of frames, sampled to choose the reference frame
+                        for superposition of trajectory files, see streaming_reference
+        seed          : seed of the random sample of frames (default 0)
+    """
+
+    def __init__(self, topology, chunk_size=5000, n_jobs=1, scratch_dir=None, scratch_dtype=np.float32,
+                 cache_dir=None, n_reference_samples=1000, seed=0):
+        self.topology = topology
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.scratch_dir = scratch_dir
+        self.scratch_dtype = scratch_dtype
+        self.cache_dir = cache_dir
+        self.n_reference_samples = n_reference_samples
+        self.seed = seed
+
+    def restraints(self, RDC_inp_file, amide=False):
+        """
+        Return RDCRestraintSet for the topology of the engine, see load_restraints
+        """
+        return load_restraints(RDC_inp_file, self.topology, amide=amide, cache_dir=self.cache_dir)
+
+    def frames(self, traj):
+        """
+        Iterate over a trajectory in chunks of chunk_size frames. traj is an MDtraj
+        Trajectory, a trajectory file or a list of files. Yields MDtraj trajectories.
+        """
+        if isinstance(traj, md.Trajectory):
+            for start in range(0, traj.n_frames, self.chunk_size):
+                yield traj[start:start+self.chunk_size]
+            return
+        for traj_file, start, stop in trajectory_segments(traj):
+            for chunk in iterate_chunks(traj_file, self.topology, self.chunk_size, start=start, stop=stop):
+                yield chunk
+
+    def reference(self, traj):
+        """
+        Choose the reference frame of trajectory files traj, see streaming_reference.
+        Returns (reference, atom_indices, frame_index)
+        """
+        if isinstance(traj, md.Trajectory):
+            raise ValueError("Reference frame is chosen only for trajectory files, "
+                             "superimpose an MDtraj Trajectory with superimpose.superpose2")
+        return streaming_reference(traj, self.topology, n_samples=self.n_reference_samples,
+                                   chunk_size=self.chunk_size, seed=self.seed)
+
+    def kernel(self, restraints):
+        """
+        Kernel of bilinear matrices of restraints, see bilin_matrix_chunk
+        """
+        return functools.partial(bilin_matrix_chunk, restraints.bond_selections, noH=restraints.amide)
+
+    def accumulate_observable(self, traj, kernel, n_items, n_components=5, weights=None, block_size=None,
+                              labels=None, n_states=None, minimize_rmsd=False, scratch_dir=None):
+        """
+        Sum observables kernel(xyz) (see accumulate_observable) over all frames of traj.
+        Trajectory files are processed by n_jobs workers (accumulate_observable_parallel),
+        an in-memory traj - by accumulate_chunks over frames(traj).
+
+        Args:
+            minimize_rmsd : if True (trajectory files only), chunks are superimposed on
+                            the reference frame before observables are computed
+            scratch_dir   : None (default) or existing directory, where observables of
+                            every frame are spilled (scratch_dtype)
+            other arguments - see accumulate_observable_parallel
+
+        Return:
+            accumulator   - ObservableAccumulator
+            scratch_files - list of tuples (file, n_of_frames), empty if scratch_dir is None
+        """
+        reference, atom_indices = None, None
+        if minimize_rmsd:
+            reference, atom_indices, frame_index = self.reference(traj)
+        if not isinstance(traj, md.Trajectory):
+            return accumulate_observable_parallel(traj, self.topology, kernel, n_items, n_components=n_components,
+                                                  chunk_size=self.chunk_size, n_jobs=self.n_jobs,
+                                                  scratch_dir=scratch_dir, scratch_dtype=self.scratch_dtype,
+                                                  block_size=block_size, reference=reference,
+                                                  atom_indices=atom_indices, weights=weights, labels=labels,
+                                                  n_states=n_states)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+        if labels is not None:
+            labels = np.asarray(labels, dtype=int)
+        kwargs = dict(n_components=n_components, scratch_dtype=self.scratch_dtype, block_size=block_size,
+                      weights=weights, labels=labels, n_states=n_states)
+        if scratch_dir is None:
+            accumulator = accumulate_chunks(self.frames(traj), kernel, n_items, **kwargs)
+            scratch_files = []
+        else:
+            scratch_file = os.path.join(scratch_dir, 'segment_0.bilin')
+            with open(scratch_file, 'wb') as scratch:
+                accumulator = accumulate_chunks(self.frames(traj), kernel, n_items, scratch=scratch, **kwargs)
+            scratch_files = [(scratch_file, accumulator.n_of_frames)]
+        check_frame_count(accumulator, weights, labels)
+        return accumulator, scratch_files
+
+    def accumulate(self, traj, restraints, weights=None, block_size=None, labels=None, n_states=None,
+                   minimize_rmsd=False, state_file=None):
+        """
+        Sum bilinear matrices of restraints over all frames of traj, see accumulate_observable.
+        state_file (trajectory files only) - None (default) or file with accumulator state,
+        see accumulate_with_state.
+
+        Return:
+            BilinAccumulator
+        """
+        if state_file is not None:
+            assert labels is None, "state_file can not be used with labels"
+            return accumulate_with_state(traj, self.topology, restraints.bond_selections, state_file,
+                                         noH=restraints.amide, chunk_size=self.chunk_size, n_jobs=self.n_jobs,
+                                         block_size=block_size, minimize_rmsd=minimize_rmsd,
+                                         n_reference_samples=self.n_reference_samples, seed=self.seed,
+                                         weights=weights)
+        accumulator, scratch_files = self.accumulate_observable(traj, self.kernel(restraints), len(restraints),
+                                                                weights=weights, block_size=block_size,
+                                                                labels=labels, n_states=n_states,
+                                                                minimize_rmsd=minimize_rmsd)
+        return accumulator
+
+    def accumulate_scratch(self, traj, restraints, scratch_dir, weights=None, minimize_rmsd=False):
+        """
+        Sum bilinear matrices of restraints over all frames of traj and spill the matrices
+        of every frame to scratch files (scratch_dtype) in an existing directory scratch_dir.
+
+        Return:
+            accumulator   - BilinAccumulator
+            scratch_files - list of tuples (file, n_of_frames), see open_scratch and
+                            back_calculate_scratch
+        """
+        return self.accumulate_observable(traj, self.kernel(restraints), len(restraints), weights=weights,
+                                          minimize_rmsd=minimize_rmsd, scratch_dir=scratch_dir)
+
+    def bilin(self, restraints, xyz):
+        """
+        Bilinear matrices of restraints for coordinates xyz with shape (n_frames, n_atoms, 3)
+        """
+        return self.kernel(restraints)(xyz)
+
+    def fit(self, F_av, exp_rdc):
+        """
+        Fit alignment tensor(s), see fit_alignment_tensor. Returns (A, D)
+        """
+        return fit_alignment_tensor(F_av, exp_rdc)
+
+    def rdc(self, traj, RDC_inp_file, amide=False, mode='average', weights=None, minimize_rmsd=False,
+            output_file=None, state_file=None):
+        """
+        Fit alignment tensor to the (weighted) average bilinear matrix of traj and
+        back-calculate RDCs, see calculate_rdc and calculate_rdc_large for arguments.
+        Trajectory files are read only once (twice if minimize_rmsd=True, the first pass
+        to find the reference frame). minimize_rmsd and state_file are effective only
+        for trajectory files.
+
+        In mode='full' bilinear matrices of all frames of trajectory files are spilled to
+        memory-mapped scratch files (deleted on return) during the single pass, and per-frame
+        RDCs are obtained from one matrix product with the fitted tensor. Frames of an
+        in-memory traj are used directly.
+
+        Return: two numpy arrays:
+                  exp_rdc - experimental values of RDCs
+                  D_av    -  back-calculated  RDCs
+        """
+        restraints = self.restraints(RDC_inp_file, amide=amide)
+        exp_rdc = np.array(restraints.RDCs)
+        if state_file is not None:
+            assert mode != 'full', "state_file can be used only with mode='average'"
+        if mode != 'full' or isinstance(traj, md.Trajectory):
+            accumulator = self.accumulate(traj, restraints, weights=weights, minimize_rmsd=minimize_rmsd,
+                                          state_file=state_file)
+            A_av, D_av = self.fit(accumulator.average(), exp_rdc)
+            if mode == 'full':
+                D_av = np.concatenate([np.dot(self.bilin(restraints, chunk.xyz), A_av)
+                                       for chunk in self.frames(traj)])
+            return(exp_rdc, D_av)
+
+        with tempfile.TemporaryDirectory(dir=self.scratch_dir) as tmp_dir:
+            accumulator, scratch_files = self.accumulate_scratch(traj, restraints, tmp_dir, weights=weights,
+                                                                 minimize_rmsd=minimize_rmsd)
+            A_av = self.fit(accumulator.average(), exp_rdc)[0]
+            D_av = back_calculate_scratch(scratch_files, len(restraints), A_av, output_file=output_file,
+                                          chunk_size=self.chunk_size, scratch_dtype=self.scratch_dtype)
+        return(exp_rdc, D_av)
+
+#####################################################################################################
+
+
+def calculate_rdc(traj_ref,RDC_inp_file,minimize_rmsd=True,superimpose=False,mode='average',
+                  weights=None, dtrajs=None, n_jobs=1, approximate_medoid=False, seed=None, rmsd_cache=None):
 
     """
     Calculate residual dipolar couplings for a trajectory, based on experimental values
@@ -137,7 +1226,7 @@ def calculate_rdc(traj_ref,RDC_inp_file,minimize_rmsd=True,superimpose=False,mod
 
        traj_ref      : MD_traj trajectory
 
-       RDC_inp_file  : file with experimental RDC values.
+       RDC_inp_file  : file with experimental RDC values, or RDCRestraintSet.
                       File format is close to NMRPipe, but NOT EXACTLY the same.
                       https://www.ibbr.umd.edu/nmrpipe/install.html
 
@@ -155,18 +1244,36 @@ def calculate_rdc(traj_ref,RDC_inp_file,minimize_rmsd=True,superimpose=False,mod
 
                        if minimize_RMSD=True (default)  a frame, minimizing
                        sum of  C_alpha RMSD with respect to all other frames is found
+                       (superimpose.superpose2)
 
                        if minimize_RMSD=False  0-th frame is used to as a reference to super
                        impose all other frames
         superimpose  : Effective only if minimize_RMSD=False. Defaulet - false.
                        If true, all frames are superimposed with respect to 0th frame.
 
+        n_jobs       : Effective only if minimize_RMSD=True. Number of processes, computing
+                       rows of C_alpha RMSD matrix (default 1)
+
+        approximate_medoid : Effective only if minimize_RMSD=True. If True, the frame is found
+                       by superimpose.approximate_medoid (with seed), which prunes rows of
+                       C_alpha RMSD matrix with the triangle inequality (default False).
+                       The error bound of the sum of RMSD and the number of computed RMSD
+                       values are printed
+
+        rmsd_cache   : Effective only if minimize_RMSD=True. None (default) or directory, where
+                       C_alpha RMSD matrix is cached (superimpose.pairwise_rmsd) and reused
+
 
         mode         : Determins the format of the result. If mode="full", the output
                        D_av is an NxM array, where N is a number of frames, M-number of residues.
 
                        If mode="average" (default), the output is  1d array with lenth M. Each entry -
                        average value over the frame.
+
+        weights      : None (default), numpy array or file with weight of each frame,
+                       or with probabilities of microstates if dtrajs is given. See frame_weights
+
+        dtrajs       : None (default), numpy array or file with microstate label of each frame
     Return: two numpy arrays:
               exp_rdc - experimental values of RDCs
               D_av    -  back-calculated  RDCs
@@ -174,94 +1281,37 @@ def calculate_rdc(traj_ref,RDC_inp_file,minimize_rmsd=True,superimpose=False,mod
 
     Dependencies:
                 Packages  :   re, np, md
-                Classes   :   Bond
-                Functions :   bilin_matrix, vector, bilin
-    """
-    RDC_input = open(RDC_inp_file,'r')
-
-    RDCs=[]
-    bonds=[]
-    for line in RDC_input.readlines():
-        match = re.search(r'^\s*(?P<resid_i>[0-9]+)'
-                            '\s*[A-Z]{3}'
-                            '\s*(?P<name_i>[A-Z\#]{1,4})'
-                            '\s*(?P<resid_j>[0-9]+)'
-                            '\s*[A-Z]{3}'
-                            '\s*(?P<name_j>[A-Z\#]{1,4})'
-                            '\s*(?P<rdc>-?[0-9\.]+)', line)
-        if match is None:
-            continue
-        RDCs.append(float(line.split()[6]))  # Work only when RDC are in the 7 coulumn!
-        bonds.append(Bond( int(line.split()[0]),
-                              (line.split()[1]),
-                              (line.split()[2]),
-                           int(line.split()[3]),
-                              (line.split()[4]),
-                              (line.split()[5]))
-                    )
-
-    RDC_input.close()
-
-    atoms_to_keep = [a.index for a in traj_ref.topology.atoms if a.name == 'CA']
-    traj_alpha = traj_ref.atom_slice(atoms_to_keep)
-
-    bond_selections=[]
-    for bond in bonds:
-        # -1 correspond to transition between PDB numeration and MDTRAJ numeration
-        # Names of atoms in input files should be the same as one used by mdtraj
-        selection_i = traj_ref.top.select('resid %i and name %s' %(bond.resid_i-1, bond.atomname_i))
-        assert(selection_i.size != 0)
-        selection_j = traj_ref.top.select('resid %i and name %s' %(bond.resid_j-1, bond.atomname_j))
-        assert(selection_j.size != 0)
-        bond_selections.append([selection_i[0], selection_j[0]])
+                Classes   :   Bond, RDCRestraintSet, NMREngine
+                Functions :   bilin_matrix_chunk, vector_chunk, bilin_chunk, superpose2
+    """
+    restraints = load_restraints(RDC_inp_file, traj_ref.topology)
 
     # According to the procedure, described in Olsson2017 papper, need to find a frame,
     # which minimizes sum of  C_alpha RMSD with respect to all other frames
-    # Quadratic algorithm  (O(N2))???
-    # Should use C-alpha trajectory!
-    #  RMSD matrix is symmetric
+    # Each row of C_alpha RMSD matrix is computed with one md.rmsd call (superimpose.superpose2)
 
     min_idx = 0
 
     if minimize_rmsd:
-        N_frame = traj_ref.n_frames
-        RMSD = np.zeros((N_frame,N_frame))
-
-        for i in range(0,N_frame):
-            for j in range(i,N_frame):
-                res = md.rmsd(traj_alpha[i],traj_alpha[j])
-                RMSD[i,j] = res
-                RMSD[j,i] = res
-
-        sum_RMSD=np.sum(RMSD,axis=0)
-        min_idx = np.argmin(sum_RMSD)
-
-        traj_ref.superpose(traj_ref, frame=min_idx)
+        if approximate_medoid:
+            traj_ref, error_bound, n_evaluations = sup.superpose2(traj_ref, approximate=True, seed=seed)
+            print("Approximate medoid: error bound of sum of C_alpha RMSD %f nm, %i of %i RMSD values computed"
+                  % (error_bound, n_evaluations, traj_ref.n_frames**2))
+        else:
+            sup.superpose2(traj_ref, n_jobs=n_jobs, seed=seed, cache_dir=rmsd_cache)
 
     elif superimpose:
         traj_ref.superpose(traj_ref, frame=min_idx)
 
 
-    F_av = np.zeros((len(bond_selections),5))
-    for i in range (0, traj_ref.n_frames):
-        F_av = F_av +  bilin_matrix(bond_selections, traj_ref[i])
-    F_av = np.divide(F_av,traj_ref.n_frames)
-    A_av, residuals,  rank,s = np.linalg.lstsq(F_av,np.array(RDCs),rcond=-1)
-
-    if mode=='average':
-        D_av=np.dot(F_av,A_av)
-
-    if mode=='full':
-        D_full=[]
-        for i in range(0,traj_ref.n_frames):
-            F=bilin_matrix(bond_selections,traj_ref[i])
-            D=np.dot(F,A_av)
-            D_full.append(D)
-        D_av=np.array(D_full)
-    exp_rdc=np.array(RDCs)
-    return(exp_rdc,D_av)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    return NMREngine(traj_ref.topology).rdc(traj_ref, restraints, mode=mode, weights=weights)
 ###########################################################################################################
-def calculate_rdc_large(traj,topology,RDC_inp_file, minimize_rmsd=True,mode='average'):
+def calculate_rdc_large(traj,topology,RDC_inp_file, minimize_rmsd=True,mode='average',chunk_size=5000,
+                        output_file=None, scratch_dir=None, scratch_dtype=np.float32, n_jobs=1,
+                        n_reference_samples=1000, seed=0, state_file=None,
+                        weights=None, dtrajs=None):
 
     """
     Calculate residual dipolar couplings based on SVD for a long trajectory,
@@ -269,11 +1319,12 @@ def calculate_rdc_large(traj,topology,RDC_inp_file, minimize_rmsd=True,mode='ave
 
     Args:
 
-       traj      : trajectory file in any format, supported by md_traj
+       traj      : trajectory file in any format, supported by md_traj,
+                   or a list of such files (replicas), treated as a single ensemble
 
        topology  : topology file (the same as one for mdtraj)
 
-       RDC_inp_file  : file with experimental RDC values.
+       RDC_inp_file  : file with experimental RDC values, or RDCRestraintSet.
                       File format is close to NMRPipe, but NOT EXACTLY the same.
                       https://www.ibbr.umd.edu/nmrpipe/install.html
 
@@ -289,13 +1340,55 @@ def calculate_rdc_large(traj,topology,RDC_inp_file, minimize_rmsd=True,mode='ave
         minimize_RMSD: Determing, whether superimposion with respect to the frame,
                        minimizing RMSD, will be done.
 
-                       if minimize_RMSD=True (default)  a frame, minimizing
-                       sum of  C_alpha RMSD with respect to all other frames is found
+                       if minimize_RMSD=True (default)  C-alpha atoms of n_reference_samples
+                       randomly chosen frames are collected during the first pass over the
+                       trajectory, and the frame, minimizing sum of C_alpha RMSD with respect
+                       to the other sampled frames, is found. During the second pass each chunk
+                       is superimposed on this frame (by all atoms, as in calculate_rdc) before
+                       calculation of RDCs. No aligned trajectory is written to disk.
+                       If the trajectory has at most n_reference_samples frames, all frames
+                       are used, and the result is the same as for calculate_rdc.
+                       Note: earlier versions ignored minimize_RMSD=True here and used
+                       the input trajectory as is.
 
-                       if minimize_RMSD=False  0-th frame is used to as a reference to super
-                       impose all other frames
+                       if minimize_RMSD=False  the input trajectory is used as is, so it
+                       should be already superimposed
+
+        n_reference_samples: number of frames sampled to find the reference frame (default 1000)
+
+        seed         : seed of the random number generator, used for sampling (default 0,
+                       so that repeated calls give the same result; None - random seed)
 
+        mode         : 'average' (default) or 'full', see calculate_rdc
 
+        chunk_size   : number of frames, read from the trajectory file at once (default 5000).
+                       Peak memory is bounded by the size of a chunk.
+
+        output_file  : Effective only if mode='full'. None (default) or name of .npy file,
+                       where back-calculated RDCs of all frames are written as a memmap.
+
+        scratch_dir  : Effective only if mode='full'. Directory for temporary file,
+                       storing bilinear matrices of all frames (default - system tmp).
+                       The trajectory is read only once.
+
+        scratch_dtype: dtype of temporary bilinear matrices (default np.float32)
+
+        n_jobs       : number of worker processes (default 1). If n_jobs > 1, the trajectory
+                       (or list of replica trajectories) is split into frame ranges, which
+                       are processed in parallel. Result is the same up to summation order.
+
+        state_file   : Effective only if mode='average'. None (default) or name of a file with
+                       the accumulator state. If the file exists, files of traj, that were
+                       processed before, are skipped and only new frames are read. The state
+                       (summed bilinear matrix, number of frames, fingerprints of processed
+                       files and the reference frame) is saved back to state_file.
+
+        weights      : None (default), numpy array or file with weight of each frame,
+                       or with probabilities of microstates if dtrajs is given.
+                       Bilinear matrices are averaged with these weights. See frame_weights
+
+        dtrajs       : None (default), numpy array or file (e.g. dtrajs.txt) with microstate
+                       label of each frame, used with per-microstate weights
 
     Return: two numpy arrays:
               exp_rdc - experimental values of RDCs
@@ -304,85 +1397,28 @@ def calculate_rdc_large(traj,topology,RDC_inp_file, minimize_rmsd=True,mode='ave
 
     Dependencies:
                 Packages  :   re, np, md
-                Classes   :   Bond
-                Functions :   bilin_matrix, vector, bilin
-    """
-    structure=md.load(topology)
-    RDC_input = open(RDC_inp_file,'r')
-
-    RDCs=[]
-    bonds=[]
-    for line in RDC_input.readlines():
-        match = re.search(r'^\s*(?P<resid_i>[0-9]+)'
-                            '\s*[A-Z]{3}'
-                            '\s*(?P<name_i>[A-Z\#]{1,4})'
-                            '\s*(?P<resid_j>[0-9]+)'
-                            '\s*[A-Z]{3}'
-                            '\s*(?P<name_j>[A-Z\#]{1,4})'
-                            '\s*(?P<rdc>-?[0-9\.]+)', line)
-        if match is None:
-            continue
-        RDCs.append(float(line.split()[6]))  # Work only when RDC are in the 7 coulumn!
-        bonds.append(Bond( int(line.split()[0]),
-                              (line.split()[1]),
-                              (line.split()[2]),
-                           int(line.split()[3]),
-                              (line.split()[4]),
-                              (line.split()[5]))
-                    )
-
-    RDC_input.close()
-
-
-    bond_selections=[]
-    for bond in bonds:
-        # -1 correspond to transition between PDB numeration and MDTRAJ numeration
-        # Names of atoms in input files should be the same as one used by mdtraj
-        selection_i = structure.top.select('resid %i and name %s' %(bond.resid_i-1, bond.atomname_i))
-        assert(selection_i.size != 0)
-        selection_j = structure.top.select('resid %i and name %s' %(bond.resid_j-1, bond.atomname_j))
-        assert(selection_j.size != 0)
-        bond_selections.append([selection_i[0], selection_j[0]])
+                Classes   :   Bond, RDCRestraintSet, NMREngine
+                Functions :   bilin_matrix_chunk, vector_chunk, bilin_chunk
+    """
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
 
     # According to the procedure, described in Olsson2017 papper, need to find a frame,
     # which minimizes sum of  C_alpha RMSD with respect to all other frames
-    # Quadratic algorithm  (O(N2))???
-    # Should use C-alpha trajectory!
-    #  RMSD matrix is symmetric
-
-    ### From this part, need to use iterator. How can we find superimposed configuration?
-    ### Solution: Use a trajectory, that has already been superimposed
-    print("NOTE: input trajectory should be superimposed")
-    if minimize_rmsd:
-        print("WARNING! RMSD minimization is not implemented in current function yet")
-        print("Use superimposed trajectory as an input")
-
-    F_av = np.zeros((len(bond_selections),5))
-    n_of_frames=0
-    print(topology)
-    for chunks in md.iterload(traj, chunk=1,top=topology):
-        n_of_frames+=1
-        F_av = F_av +  bilin_matrix(bond_selections, chunks)
-    F_av = np.divide(F_av,n_of_frames)
-    A_av, residuals,  rank,s = np.linalg.lstsq(F_av,np.array(RDCs),rcond=-1)
-
-
-    if mode=='average':
-        D_av=np.dot(F_av,A_av)
-
-    if mode=='full':
-        D_full=[]
-        for chunks in md.iterload(traj, chunk=1,top=topology):
-            F=bilin_matrix(bond_selections,chunks)
-            D=np.dot(F,A_av)
-            D_full.append(D)
-        D_av=np.array(D_full)
-
-    exp_rdc=np.array(RDCs)
-    return(exp_rdc,D_av)
+    # For a trajectory read from file, the frame is searched among a random sample of frames
+    if not minimize_rmsd:
+        print("NOTE: input trajectory should be superimposed")
+
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs, scratch_dir=scratch_dir,
+                       scratch_dtype=scratch_dtype, n_reference_samples=n_reference_samples, seed=seed)
+    return engine.rdc(traj, RDC_inp_file, mode=mode, weights=weights, minimize_rmsd=minimize_rmsd,
+                      output_file=output_file, state_file=state_file)
 ##############################################################################################################
 
-def calculate_rdc_amide_large(traj, topology, RDC_inp_file, minimize_rmsd=True, mode='average'):
+def calculate_rdc_amide_large(traj, topology, RDC_inp_file, minimize_rmsd=True, mode='average', chunk_size=5000,
+                              output_file=None, scratch_dir=None, scratch_dtype=np.float32, n_jobs=1,
+                        n_reference_samples=1000, seed=0, state_file=None,
+                        weights=None, dtrajs=None):
     """
     Calculate residual dipolar couplings for amide NH bond based on SVD for a long trajectory,
     when the trajectory cannot be loaded in the memory as a whole.
@@ -392,11 +1428,12 @@ def calculate_rdc_amide_large(traj, topology, RDC_inp_file, minimize_rmsd=True,
 
     Args:
 
-       traj      : trajectory file in any format, supported by md_traj
+       traj      : trajectory file in any format, supported by md_traj,
+                   or a list of such files (replicas), treated as a single ensemble
 
        topology  : topology file (the same as one for mdtraj)
 
-       RDC_inp_file  : file with experimental RDC values.
+       RDC_inp_file  : file with experimental RDC values, or RDCRestraintSet.
                       File format is close to NMRPipe, but NOT EXACTLY the same.
                       https://www.ibbr.umd.edu/nmrpipe/install.html
 
@@ -412,13 +1449,55 @@ def calculate_rdc_amide_large(traj, topology, RDC_inp_file, minimize_rmsd=True,
         minimize_RMSD: Determing, whether superimposion with respect to the frame,
                        minimizing RMSD, will be done.
 
-                       if minimize_RMSD=True (default)  a frame, minimizing
-                       sum of  C_alpha RMSD with respect to all other frames is found
+                       if minimize_RMSD=True (default)  C-alpha atoms of n_reference_samples
+                       randomly chosen frames are collected during the first pass over the
+                       trajectory, and the frame, minimizing sum of C_alpha RMSD with respect
+                       to the other sampled frames, is found. During the second pass each chunk
+                       is superimposed on this frame (by all atoms, as in calculate_rdc) before
+                       calculation of RDCs. No aligned trajectory is written to disk.
+                       If the trajectory has at most n_reference_samples frames, all frames
+                       are used, and the result is the same as for calculate_rdc.
+                       Note: earlier versions ignored minimize_RMSD=True here and used
+                       the input trajectory as is.
 
-                       if minimize_RMSD=False  0-th frame is used to as a reference to super
-                       impose all other frames
+                       if minimize_RMSD=False  the input trajectory is used as is, so it
+                       should be already superimposed
 
+        n_reference_samples: number of frames sampled to find the reference frame (default 1000)
 
+        seed         : seed of the random number generator, used for sampling (default 0,
+                       so that repeated calls give the same result; None - random seed)
+
+        mode         : 'average' (default) or 'full', see calculate_rdc
+
+        chunk_size   : number of frames, read from the trajectory file at once (default 5000).
+                       Peak memory is bounded by the size of a chunk.
+
+        output_file  : Effective only if mode='full'. None (default) or name of .npy file,
+                       where back-calculated RDCs of all frames are written as a memmap.
+
+        scratch_dir  : Effective only if mode='full'. Directory for temporary file,
+                       storing bilinear matrices of all frames (default - system tmp).
+                       The trajectory is read only once.
+
+        scratch_dtype: dtype of temporary bilinear matrices (default np.float32)
+
+        n_jobs       : number of worker processes (default 1). If n_jobs > 1, the trajectory
+                       (or list of replica trajectories) is split into frame ranges, which
+                       are processed in parallel. Result is the same up to summation order.
+
+        state_file   : Effective only if mode='average'. None (default) or name of a file with
+                       the accumulator state. If the file exists, files of traj, that were
+                       processed before, are skipped and only new frames are read. The state
+                       (summed bilinear matrix, number of frames, fingerprints of processed
+                       files and the reference frame) is saved back to state_file.
+
+        weights      : None (default), numpy array or file with weight of each frame,
+                       or with probabilities of microstates if dtrajs is given.
+                       Bilinear matrices are averaged with these weights. See frame_weights
+
+        dtrajs       : None (default), numpy array or file (e.g. dtrajs.txt) with microstate
+                       label of each frame, used with per-microstate weights
 
     Return: two numpy arrays:
               exp_rdc - experimental values of RDCs
@@ -427,77 +1506,635 @@ def calculate_rdc_amide_large(traj, topology, RDC_inp_file, minimize_rmsd=True,
 
     Dependencies:
                 Packages  :   re, np, md
-                Classes   :   Bond
-                Functions :   bilin_matrix, vector, bilin
-    """
-    structure = md.load(topology)
-    RDC_input = open(RDC_inp_file, 'r')
-
-    RDCs = []
-    bonds = []
-    for line in RDC_input.readlines():
-        match = re.search(r'^\s*(?P<resid_i>[0-9]+)'
-                          '\s*[A-Z]{3}'
-                          '\s*(?P<name_i>[A-Z\#]{1,4})'
-                          '\s*(?P<resid_j>[0-9]+)'
-                          '\s*[A-Z]{3}'
-                          '\s*(?P<name_j>[A-Z\#]{1,4})'
-                          '\s*(?P<rdc>-?[0-9\.]+)', line)
-        if match is None:
-            continue
-        RDCs.append(float(line.split()[6]))  # Work only when RDC are in the 7 coulumn!
-        assert line.split()[2] == 'N' or line.split()[5] == 'N', "Should have atom N in the bond"
-        assert line.split()[2] == 'H' or line.split()[5] == 'H', "Should have atom H  in the bond"
-        assert line.split()[0] == line.split()[3], "Atoms in a bond should belong to the same residue"
-        assert line.split()[1] == line.split()[4], "Atoms in a bond should belong to the same residue"
-        assert line.split()[0] != 1, "RDC calculation for the first residue is not implemented yet. Use trajectory with hydrogens"
-        bonds.append(Bond(int(line.split()[0]),
-                          (line.split()[1]),
-                          (line.split()[2]),
-                          int(line.split()[3]),
-                          (line.split()[4]),
-                          (line.split()[5]))
-                     )
-
-    RDC_input.close()
-
-    bond_selections = []
-    for bond in bonds:
-        # -1 correspond to transition between PDB numeration and MDTRAJ numeration
-        # Names of atoms in input files should be the same as one used by mdtraj
-        selection_C = structure.top.select('resid %i and name C' % (bond.resid_i-2))
-        assert(selection_C.size != 0)
-        selection_N = structure.top.select('resid %i and name N' % (bond.resid_j-1))
-        assert(selection_N.size != 0)
-        selection_CA = structure.top.select('resid %i and name CA' % (bond.resid_j-1))
-        assert(selection_CA.size != 0)
-        bond_selections.append([selection_C[0], selection_N[0], selection_CA[0]])
-
-    # Use a trajectory, that has already been superimposed
-    print("NOTE: input trajectory should be superimposed")
-    if minimize_rmsd:
-        print("WARNING! RMSD minimization is not implemented in current function yet")
-        print("Use superimposed trajectory as an input")
-    F_av = np.zeros((len(bond_selections), 5))
-    n_of_frames = 0
-    print(topology)
-    for chunks in md.iterload(traj, chunk=1, top=topology):
-        n_of_frames += 1
-        F_av = F_av + bilin_matrix(bond_selections, chunks, noH=True)
-    F_av = np.divide(F_av, n_of_frames)
-    A_av, residuals,  rank, s = np.linalg.lstsq(F_av, np.array(RDCs), rcond=-1)
-
-    if mode == 'average':
-        D_av = np.dot(F_av, A_av)
-
-    if mode == 'full':
-        D_full = []
-        for chunks in md.iterload(traj, chunk=1, top=topology):
-            F = bilin_matrix(bond_selections, chunks, noH=True)
-            D = np.dot(F, A_av)
-            D_full.append(D)
-        D_av = np.array(D_full)
-
-    exp_rdc = np.array(RDCs)
-    return(exp_rdc, D_av)
+                Classes   :   Bond, RDCRestraintSet, NMREngine
+                Functions :   bilin_matrix_chunk, vector_chunk, bilin_chunk
+    """
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+
+    if not minimize_rmsd:
+        print("NOTE: input trajectory should be superimposed")
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs, scratch_dir=scratch_dir,
+                       scratch_dtype=scratch_dtype, n_reference_samples=n_reference_samples, seed=seed)
+    return engine.rdc(traj, RDC_inp_file, amide=True, mode=mode, weights=weights, minimize_rmsd=minimize_rmsd,
+                      output_file=output_file, state_file=state_file)
+####################################################################################################
+
+def calculate_rdc_multi(traj, topology, RDC_inp_files, amide=False, mode='average', chunk_size=5000,
+                        output_files=None, scratch_dir=None, scratch_dtype=np.float32, n_jobs=1,
+                        weights=None, dtrajs=None):
+    """
+    Calculate residual dipolar couplings for several alignment media in a single pass
+    over a long trajectory. Bilinear terms are computed once per frame for the union of
+    bonds of all media, and an alignment tensor is fitted for each medium separately.
+    The input trajectory should be superimposed.
+
+    Args:
+
+       traj          : trajectory file or list of files, see calculate_rdc_large
+
+       topology      : topology file (the same as one for mdtraj)
+
+       RDC_inp_files : list of files with experimental RDC values (one per alignment medium)
+                       or RDCRestraintSet objects, see calculate_rdc
+
+       amide         : If True, N-H vectors are reconstructed from C(i-1), N(i) and CA(i)
+                       atoms, as in calculate_rdc_amide_large (default False)
+
+       mode          : 'average' (default) or 'full', see calculate_rdc
+
+       output_files  : Effective only if mode='full'. None (default) or list of .npy files,
+                       one per medium, where back-calculated RDCs are written as memmaps
+
+       chunk_size, scratch_dir, scratch_dtype, n_jobs, weights, dtrajs : see calculate_rdc_large
+
+    Return: three lists with one element per medium:
+              exp_rdc - experimental values of RDCs
+              D_av    - back-calculated RDCs
+              A_av    - fitted alignment tensors
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs, scratch_dir=scratch_dir,
+                       scratch_dtype=scratch_dtype)
+    restraint_sets = [engine.restraints(RDC_inp_file, amide=amide) for RDC_inp_file in RDC_inp_files]
+    union, bond_indexes = RDCRestraintSet.union(restraint_sets)
+    if output_files is None:
+        output_files = [None]*len(restraint_sets)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+        if mode == 'full':
+            accumulator, scratch_files = engine.accumulate_scratch(traj, union, tmp_dir, weights=weights)
+        else:
+            accumulator = engine.accumulate(traj, union, weights=weights)
+        F_av = accumulator.average()
+        exp_rdc, D_av, A_av = [], [], []
+        for restraints, bond_index, output_file in zip(restraint_sets, bond_indexes, output_files):
+            A, D = engine.fit(F_av[bond_index], restraints.RDCs)
+            if mode == 'full':
+                D = back_calculate_scratch(scratch_files, len(union), A, bond_index=bond_index,
+                                           output_file=output_file, chunk_size=chunk_size,
+                                           scratch_dtype=scratch_dtype)
+            exp_rdc.append(restraints.RDCs)
+            D_av.append(D)
+            A_av.append(A)
+    return(exp_rdc, D_av, A_av)
+####################################################################################################
+
+def fit_alignment_tensor(F_av, exp_rdc):
+    """
+    Least-squares fit of alignment tensors, vectorized over leading axes of F_av.
+
+    Args:
+        F_av    : averaged bilinear matrix with shape (..., n_bonds, 5)
+        exp_rdc : experimental RDCs with length n_bonds
+
+    Return:
+        A - alignment tensors with shape (..., 5). For a single matrix, the same as
+            np.linalg.lstsq(F_av, exp_rdc, rcond=-1)[0]
+        D - back-calculated RDCs with shape (..., n_bonds)
+    """
+    A = np.einsum('...kb,b->...k', np.linalg.pinv(F_av), exp_rdc)
+    D = np.einsum('...bk,...k->...b', F_av, A)
+    return A, D
+
+
+def rdc_q_factor(exp_rdc, D):
+    """
+    Q-factor for back-calculated RDCs D with shape (..., n_bonds), vectorized over
+    leading axes. Equivalent to analysis.q_factor with normalization='n'
+    """
+    return np.sqrt(np.mean(np.square(D - exp_rdc), axis=-1)/np.mean(np.square(exp_rdc)))
+
+
+def rdc_cross_validation(exp_rdc, F_av, n_folds=None, seed=None):
+    """
+    Cross-validated (free) Q-factor of the alignment tensor fit, vectorized over leading
+    axes of F_av (e.g. over blocks: F_blocks/block_frames[:, None, None]).
+    Each RDC is predicted by the tensor fitted without it (leave-one-out) or without
+    its fold (k-fold). Instead of a separate fit for every left-out set, the prediction
+    is obtained from the residuals of the full fit and the hat matrix H = F pinv(F):
+        leave-one-out: D_free[i] = exp_rdc[i] - e[i]/(1 - H[i,i])
+        k-fold:        D_free[S] = exp_rdc[S] - (I - H[S,S])^-1 e[S]
+
+    Args:
+        exp_rdc : experimental RDCs with length n_bonds
+        F_av    : averaged bilinear matrix with shape (..., n_bonds, 5)
+        n_folds : None (default) - leave-one-out; otherwise number of random folds
+        seed    : seed of random number generator, used to split bonds into folds
+
+    Return:
+        Q_free - cross-validated Q-factor with shape of leading axes of F_av
+        D_free - predicted RDCs with shape (..., n_bonds); nan (and nan Q_free) if left-out
+                 RDCs are not determined by the rest (leverage 1)
+    """
+    exp_rdc = np.asarray(exp_rdc, dtype=np.float64)
+    n_bonds = len(exp_rdc)
+    fold_size = 1 if n_folds is None else -(-n_bonds//n_folds)
+    if n_bonds - fold_size < 5:
+        raise ValueError("Cross-validation needs at least 5 RDCs in each fit, got %i RDCs and folds of %i"
+                         % (n_bonds, fold_size))
+    H = np.einsum('...bk,...kc->...bc', F_av, np.linalg.pinv(F_av))
+    residuals = exp_rdc - np.einsum('...bc,c->...b', H, exp_rdc)
+    if n_folds is None:
+        # bonds with leverage 1 are not determined by the rest of the bonds
+        I_H = 1 - np.einsum('...bb->...b', H)
+        singular = I_H < 1e-8
+        D_free = exp_rdc - residuals/np.where(singular, 1, I_H)
+        D_free[singular] = np.nan
+    else:
+        rng = np.random.default_rng(seed)
+        folds = np.array_split(rng.permutation(n_bonds), n_folds)
+        D_free = np.empty_like(residuals)
+        for fold in folds:
+            # eigenvalues of I - H[S,S] are within [0, 1]; 0 - the fold is not determined by the rest
+            I_H = np.eye(len(fold)) - H[..., fold[:, None], fold]
+            singular = np.linalg.eigvalsh(I_H)[..., 0] < 1e-8
+            I_H[singular] = np.eye(len(fold))
+            D_fold = exp_rdc[fold] - np.linalg.solve(I_H, residuals[..., fold, None])[..., 0]
+            D_free[..., fold] = np.where(singular[..., None], np.nan, D_fold)
+    return(rdc_q_factor(exp_rdc, D_free), D_free)
+
+
+def calculate_rdc_blocks(traj, topology, RDC_inp_file, block_size, amide=False, chunk_size=5000, n_jobs=1,
+                         state_file=None, weights=None, dtrajs=None):
+    """
+    Read a long trajectory once and return sums of bilinear matrices over consecutive
+    blocks of frames. The result can be used by rdc_block_average, rdc_bootstrap and
+    rdc_convergence without further passes over the trajectory.
+    The input trajectory should be superimposed.
+
+    Args:
+       traj, topology, RDC_inp_file, chunk_size, n_jobs : see calculate_rdc_large
+       block_size : number of frames in a block
+       amide      : if True, the same bond reconstruction as in calculate_rdc_amide_large
+       state_file : None (default) or file with accumulator state, see calculate_rdc_large
+       weights, dtrajs : weights of frames, see calculate_rdc_large
+
+    Return: three numpy arrays:
+              exp_rdc      - experimental values of RDCs
+              F_blocks     - sums of bilinear matrices with shape (n_blocks, n_bonds, 5)
+              block_frames - numbers of frames in blocks (sums of weights, if frames are weighted)
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    restraints = engine.restraints(RDC_inp_file, amide=amide)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    accumulator = engine.accumulate(traj, restraints, weights=weights, block_size=block_size,
+                                    state_file=state_file)
+    F_blocks, block_frames = accumulator.blocks()
+    return(restraints.RDCs, F_blocks, block_frames)
+
+
+def rdc_block_average(exp_rdc, F_blocks, block_frames):
+    """
+    Block averaging estimate of uncertainties of Q-factor and alignment tensor.
+    The tensor is fitted to each block separately; the error is the standard error
+    of the mean over blocks.
+
+    Args: see the output of calculate_rdc_blocks
+
+    Return:
+        Q       - Q-factor of the whole trajectory
+        Q_error - standard error of Q-factor
+        A       - alignment tensor of the whole trajectory
+        A_error - standard error of alignment tensor components
+    """
+    n_blocks = F_blocks.shape[0]
+    A, D = fit_alignment_tensor(np.sum(F_blocks, axis=0)/np.sum(block_frames), exp_rdc)
+    Q = rdc_q_factor(exp_rdc, D)
+    A_blocks, D_blocks = fit_alignment_tensor(F_blocks/block_frames[:, None, None], exp_rdc)
+    Q_blocks = rdc_q_factor(exp_rdc, D_blocks)
+    Q_error = np.std(Q_blocks, ddof=1)/np.sqrt(n_blocks)
+    A_error = np.std(A_blocks, axis=0, ddof=1)/np.sqrt(n_blocks)
+    return(Q, Q_error, A, A_error)
+
+
+def rdc_bootstrap(exp_rdc, F_blocks, block_frames, n_bootstrap=1000, confidence=0.95, seed=None):
+    """
+    Block bootstrap confidence intervals of Q-factor and alignment tensor.
+    Blocks are resampled with replacement, so no additional passes over the
+    trajectory are needed.
+
+    Args:
+        exp_rdc, F_blocks, block_frames : see the output of calculate_rdc_blocks
+        n_bootstrap : number of bootstrap samples (default 1000)
+        confidence  : confidence level of intervals (default 0.95)
+        seed        : seed of random number generator
+
+    Return:
+        Q_interval - numpy array [lower, upper] bounds of Q-factor
+        A_interval - numpy array with shape (2, 5), lower and upper bounds of tensor components
+        Q_samples  - Q-factors of all bootstrap samples
+    """
+    rng = np.random.default_rng(seed)
+    n_blocks = F_blocks.shape[0]
+    counts = np.stack([np.bincount(sample, minlength=n_blocks)
+                       for sample in rng.integers(0, n_blocks, size=(n_bootstrap, n_blocks))])
+    F_samples = np.einsum('rb,bnk->rnk', counts, F_blocks)/np.dot(counts, block_frames)[:, None, None]
+    A_samples, D_samples = fit_alignment_tensor(F_samples, exp_rdc)
+    Q_samples = rdc_q_factor(exp_rdc, D_samples)
+    percentiles = [50*(1-confidence), 50*(1+confidence)]
+    Q_interval = np.percentile(Q_samples, percentiles)
+    A_interval = np.percentile(A_samples, percentiles, axis=0)
+    return(Q_interval, A_interval, Q_samples)
+
+
+def rdc_convergence(exp_rdc, F_blocks, block_frames):
+    """
+    Convergence curve: Q-factor and alignment tensor, fitted to the first 1, 2, ..., n_blocks blocks.
+
+    Args: see the output of calculate_rdc_blocks
+
+    Return:
+        n_frames - number of frames at the end of each block
+        Q        - Q-factors with length n_blocks
+        A        - alignment tensors with shape (n_blocks, 5)
+    """
+    n_frames = np.cumsum(block_frames)
+    A, D = fit_alignment_tensor(np.cumsum(F_blocks, axis=0)/n_frames[:, None, None], exp_rdc)
+    return(n_frames, rdc_q_factor(exp_rdc, D), A)
+####################################################################################################
+
+def calculate_rdc_checkpoints(traj, topology, RDC_inp_file, checkpoints, window=None, amide=False,
+                              chunk_size=5000, n_jobs=1, weights=None, dtrajs=None):
+    """
+    Q-factor and alignment tensor at given frame checkpoints, from a single pass over a
+    long trajectory. Sums of bilinear matrices are accumulated between consecutive
+    checkpoints (and window starts), and the estimate at each checkpoint is obtained
+    from prefix sums. The input trajectory should be superimposed.
+
+    Args:
+       traj, topology, RDC_inp_file, chunk_size, n_jobs : see calculate_rdc_large
+       checkpoints : strictly increasing positive frame numbers c. The estimate at c uses frames [0, c)
+                     (window=None, cumulative) or frames [c - window, c) (sliding window)
+       window      : None (default) or number of frames in a sliding window
+       amide       : if True, the same bond reconstruction as in calculate_rdc_amide_large
+       weights, dtrajs : weights of frames, see calculate_rdc_large
+
+    Return:
+        exp_rdc - experimental values of RDCs
+        Q       - Q-factors at checkpoints
+        A       - alignment tensors with shape (n_checkpoints, 5)
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    restraints = engine.restraints(RDC_inp_file, amide=amide)
+    checkpoints = np.asarray(checkpoints, dtype=int)
+    if checkpoints.ndim != 1 or len(checkpoints) == 0:
+        raise ValueError("checkpoints should be a non-empty list of frame numbers")
+    if checkpoints[0] <= 0 or np.any(np.diff(checkpoints) <= 0):
+        raise ValueError("checkpoints should be positive and strictly increasing")
+    if window is not None and window < 1:
+        raise ValueError("window should be at least 1 frame")
+    starts = np.zeros_like(checkpoints) if window is None else np.maximum(checkpoints - window, 0)
+    edges = np.unique(np.concatenate(([0], starts, checkpoints)))
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    accumulator = engine.accumulate(traj, restraints, weights=weights, block_size=edges)
+    if checkpoints.max() > accumulator.n_of_frames:
+        raise ValueError("Checkpoint %i is beyond the end of trajectory (%i frames)"
+                         % (checkpoints.max(), accumulator.n_of_frames))
+
+    # prefix sums over frames [0, edges[k]); blocks without frames are absent
+    F_dense = np.zeros((len(edges), len(restraints), 5))
+    frames_dense = np.zeros(len(edges))
+    for block in accumulator.block_sums:
+        F_dense[block] = accumulator.block_sums[block]
+        frames_dense[block] = accumulator.block_frames[block]
+    F_prefix = np.concatenate((np.zeros((1, len(restraints), 5)), np.cumsum(F_dense, axis=0)))
+    frames_prefix = np.concatenate(([0], np.cumsum(frames_dense)))
+    stop = np.searchsorted(edges, checkpoints)
+    start = np.searchsorted(edges, starts)
+    F_av = (F_prefix[stop] - F_prefix[start])/(frames_prefix[stop] - frames_prefix[start])[:, None, None]
+    A, D = engine.fit(F_av, restraints.RDCs)
+    return(restraints.RDCs, rdc_q_factor(restraints.RDCs, D), A)
+
+
+def calculate_rdc_states(traj, topology, RDC_inp_file, dtrajs, n_states=None, fit='joint', amide=False,
+                         chunk_size=5000, n_jobs=1, weights=None):
+    """
+    Back-calculate RDCs for each microstate of an MSM in a single pass over a long trajectory.
+    Bilinear matrices are summed over frames of each microstate (scatter-add into an
+    n_states x n_bonds x 5 array). The input trajectory should be superimposed.
+
+    Args:
+       traj, topology, RDC_inp_file, chunk_size, n_jobs : see calculate_rdc_large
+       dtrajs   : numpy array or file (e.g. dtrajs.txt) with 0-based microstate of each frame
+       n_states : number of microstates (default - max(dtrajs)+1)
+       fit      : 'joint' (default) - one alignment tensor is fitted to the average over all
+                  frames and used for all microstates;
+                  'state' - the tensor is fitted for each microstate separately
+       amide    : if True, the same bond reconstruction as in calculate_rdc_amide_large
+       weights  : None (default), numpy array or file with weight of each frame
+                  (e.g. reweighting factors)
+
+    Return:
+        exp_rdc     - experimental values of RDCs
+        D_states    - back-calculated RDCs with shape (n_states, n_bonds); nan for empty microstates
+        populations - fraction of frames (of total weight) in each microstate
+        A           - alignment tensor (5,) if fit='joint', or (n_states, 5) if fit='state'
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    restraints = engine.restraints(RDC_inp_file, amide=amide)
+    if isinstance(dtrajs, str):
+        dtrajs = np.loadtxt(dtrajs, dtype=int)
+    dtrajs = np.asarray(dtrajs, dtype=int).ravel()
+    if n_states is None:
+        n_states = int(np.max(dtrajs)) + 1
+    if weights is not None:
+        weights = frame_weights(weights)
+    accumulator = engine.accumulate(traj, restraints, weights=weights, labels=dtrajs, n_states=n_states)
+    populations = accumulator.state_frames/accumulator.weight_sum
+    occupied = accumulator.state_frames > 0
+    F_states = np.full_like(accumulator.state_sums, np.nan)
+    F_states[occupied] = accumulator.state_sums[occupied]/accumulator.state_frames[occupied, None, None]
+    exp_rdc = restraints.RDCs
+    if fit == 'joint':
+        A, D = engine.fit(accumulator.average(), exp_rdc)
+        D_states = np.einsum('sbk,k->sb', F_states, A)
+    elif fit == 'state':
+        A = np.full((n_states, 5), np.nan)
+        D_states = np.full((n_states, len(exp_rdc)), np.nan)
+        A[occupied], D_states[occupied] = engine.fit(F_states[occupied], exp_rdc)
+    else:
+        raise ValueError("fit should be either 'joint' or 'state'")
+    return(exp_rdc, D_states, populations, A)
+####################################################################################################
+
+def open_scratch(scratch_files, n_bonds, scratch_dtype=np.float32):
+    """
+    Open scratch files, written by accumulate_bilin_parallel, as read-only memmaps
+    with shape (n_of_frames, n_bonds, 5). Empty segments are skipped.
+    """
+    return [np.memmap(scratch_file, dtype=scratch_dtype, mode='r', shape=(n_segment, n_bonds, 5))
+            for scratch_file, n_segment in scratch_files if n_segment > 0]
+
+
+def reweight_rdc(exp_rdc, F_frames, theta=1.0, sigma=None, prior_weights=None, batch_size=5000,
+                 max_iter=1000, tol=1e-10):
+    """
+    Maximum entropy (Bayesian) reweighting of an ensemble against experimental RDCs.
+    Frame weights w minimize
+
+        L(w) = chi2(w)/2 + theta * sum_i w_i ln(w_i/w0_i),
+        chi2(w) = sum_b ((F_av(w) A(w) - exp_rdc)_b / sigma_b)^2,   F_av(w) = sum_i w_i F_i
+
+    where the alignment tensor A(w) is refitted for every set of weights and w0 are
+    prior weights. Since A(w) minimizes chi2, the gradient is
+        dchi2/dw_i = 2 sum_b r_b/sigma_b^2 (F_i A)_b,  r = F_av A - exp_rdc,
+    so each evaluation of L and its gradient needs two passes over bilinear matrices of
+    frames in batches of batch_size frames (they can be memmaps, see open_scratch).
+    Weights are parametrized as w = w0 exp(u)/Z and L is minimized over u by L-BFGS.
+
+    Args:
+        exp_rdc       : experimental RDCs with length n_bonds
+        F_frames      : numpy array (or memmap) with shape (n_frames, n_bonds, 5),
+                        or list of such arrays (segments), treated as one trajectory
+        theta         : confidence in the prior ensemble. Large theta - weights close to
+                        prior, small theta - close fit of experimental data
+        sigma         : None (default) or numpy array with experimental errors of RDCs
+        prior_weights : None (default - uniform) or numpy array with prior weight of each frame
+        batch_size    : number of frames processed at once
+        max_iter, tol : parameters of L-BFGS
+
+    Return:
+        weights - numpy array with optimized weight of each frame (sum to 1)
+        A       - alignment tensor, fitted to the reweighted ensemble
+        D_av    - back-calculated RDCs of the reweighted ensemble
+        phi     - fraction of effective frames exp(-sum_i w_i ln(w_i/w0_i))
+    """
+    if not isinstance(F_frames, (list, tuple)):
+        F_frames = [F_frames]
+    exp_rdc = np.asarray(exp_rdc, dtype=np.float64)
+    sigma = np.ones(len(exp_rdc)) if sigma is None else np.asarray(sigma, dtype=np.float64)
+    n_frames = sum(F.shape[0] for F in F_frames)
+    if prior_weights is None:
+        prior_weights = np.ones(n_frames)
+    prior_weights = np.asarray(prior_weights, dtype=np.float64)
+    assert len(prior_weights) == n_frames, "Number of prior weights is not equal to number of frames"
+    log_prior = np.log(prior_weights/np.sum(prior_weights))
+    batches = [(F, offset + start, F[start:start+batch_size])
+               for F, offset in zip(F_frames, np.cumsum([0] + [F.shape[0] for F in F_frames]))
+               for start in range(0, F.shape[0], batch_size)]
+
+    def weights_of(u):
+        log_w = log_prior + u
+        log_w -= np.max(log_w)
+        w = np.exp(log_w)
+        return w/np.sum(w)
+
+    def fit(w):
+        F_av = np.zeros((len(exp_rdc), 5))
+        for F, start, F_batch in batches:
+            F_av += np.tensordot(w[start:start+F_batch.shape[0]], F_batch, axes=1)
+        A = fit_alignment_tensor(F_av/sigma[:, None], exp_rdc/sigma)[0]
+        return A, np.dot(F_av, A)
+
+    def loss(u):
+        w = weights_of(u)
+        A, D_av = fit(w)
+        r = (D_av - exp_rdc)/sigma
+        entropy = np.sum(w*(np.log(np.maximum(w, 1e-300)) - log_prior))
+        M = np.outer(r/sigma, A)
+        g = np.empty(n_frames)
+        for F, start, F_batch in batches:
+            g[start:start+F_batch.shape[0]] = 2*np.tensordot(F_batch, M, axes=([1, 2], [0, 1]))
+        g = 0.5*g + theta*(np.log(np.maximum(w, 1e-300)) - log_prior)
+        return 0.5*np.sum(r**2) + theta*entropy, w*(g - np.dot(w, g))
+
+    result = optimize.minimize(loss, np.zeros(n_frames), jac=True, method='L-BFGS-B',
+                               options=dict(maxiter=max_iter, ftol=tol, gtol=tol))
+    weights = weights_of(result.x)
+    A, D_av = fit(weights)
+    phi = np.exp(-np.sum(weights*(np.log(np.maximum(weights, 1e-300)) - log_prior)))
+    return(weights, A, D_av, phi)
+
+
+def calculate_rdc_reweighted(traj, topology, RDC_inp_file, theta=1.0, sigma=None, amide=False,
+                             chunk_size=5000, n_jobs=1, scratch_dir=None, scratch_dtype=np.float32,
+                             weights=None, dtrajs=None, max_iter=1000):
+    """
+    Reweight a long trajectory against experimental RDCs (see reweight_rdc). The trajectory
+    is read once: bilinear matrices of all frames are spilled to memory-mapped scratch
+    files (deleted on return), and the optimization runs over them in batches of
+    chunk_size frames. The input trajectory should be superimposed.
+
+    Args:
+       traj, topology, RDC_inp_file, chunk_size, n_jobs, scratch_dir, scratch_dtype :
+                  see calculate_rdc_large
+       theta, sigma, max_iter : see reweight_rdc
+       amide    : if True, the same bond reconstruction as in calculate_rdc_amide_large
+       weights, dtrajs : prior weights of frames, see frame_weights (default - uniform)
+
+    Return:
+        exp_rdc - experimental values of RDCs
+        D_av    - back-calculated RDCs of the reweighted ensemble
+        weights - optimized weight of each frame
+        A       - alignment tensor of the reweighted ensemble
+        phi     - fraction of effective frames
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs, scratch_dir=scratch_dir,
+                       scratch_dtype=scratch_dtype)
+    restraints = engine.restraints(RDC_inp_file, amide=amide)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+        accumulator, scratch_files = engine.accumulate_scratch(traj, restraints, tmp_dir)
+        F_frames = open_scratch(scratch_files, len(restraints), scratch_dtype=scratch_dtype)
+        weights, A, D_av, phi = reweight_rdc(restraints.RDCs, F_frames, theta=theta, sigma=sigma,
+                                             prior_weights=weights, batch_size=chunk_size, max_iter=max_iter)
+        del F_frames
+    return(restraints.RDCs, D_av, weights, A, phi)
+####################################################################################################
+
+def order_parameters(F_av):
+    """
+    Generalized order parameters S2 of bonds from averaged bilinear matrices, vectorized
+    over leading axes. Since bond vectors are normalized, the averaged bilinear components
+    determine all second moments <u_a u_b> of unit bond vectors:
+        <z^2> = (1 - F0 - F1)/3, <x^2> = F0 + <z^2>, <y^2> = F1 + <z^2>,
+        <xy> = F2/2, <xz> = F3/2, <yz> = F4/2
+    and S2 = 3/2 sum_ab <u_a u_b>^2 - 1/2. So RDCs and S2 are obtained from the same
+    accumulated sums (e.g. the output of calculate_rdc_blocks).
+
+    Args:
+        F_av : averaged bilinear matrix with shape (..., n_bonds, 5)
+
+    Return:
+        S2 - numpy array with shape (..., n_bonds)
+    """
+    zz = (1 - F_av[..., 0] - F_av[..., 1])/3
+    xx = F_av[..., 0] + zz
+    yy = F_av[..., 1] + zz
+    diagonal = xx**2 + yy**2 + zz**2
+    off_diagonal = 0.5*np.sum(F_av[..., 2:]**2, axis=-1)
+    return 1.5*(diagonal + off_diagonal) - 0.5
+
+
+def sliding_block_sums(F_blocks, block_frames, window):
+    """
+    Sums of bilinear matrices over sliding windows of consecutive blocks (step of one block),
+    obtained from prefix sums of block sums.
+
+    Args:
+        F_blocks, block_frames : see the output of calculate_rdc_blocks
+        window                 : number of blocks in a window
+
+    Return:
+        F_windows     - sums with shape (n_blocks - window + 1, n_bonds, 5)
+        window_frames - numbers of frames (sums of weights) in windows
+    """
+    assert 0 < window <= F_blocks.shape[0], "window should be between 1 and number of blocks"
+    F_prefix = np.concatenate((np.zeros((1,) + F_blocks.shape[1:]), np.cumsum(F_blocks, axis=0)))
+    frames_prefix = np.concatenate(([0], np.cumsum(block_frames)))
+    return(F_prefix[window:] - F_prefix[:-window], frames_prefix[window:] - frames_prefix[:-window])
+
+
+def calculate_s2(traj, topology, RDC_inp_file, amide=False, block_size=None, window=None,
+                 chunk_size=5000, n_jobs=1, weights=None, dtrajs=None):
+    """
+    Calculate order parameters S2 of bonds in a single pass over a long trajectory,
+    see order_parameters. Bonds are taken from the RDC restraint file (or RDCRestraintSet),
+    so S2 and RDCs refer to the same bonds. The input trajectory should be superimposed.
+
+    Args:
+       traj, topology, RDC_inp_file, chunk_size, n_jobs : see calculate_rdc_large
+       amide      : if True, the same bond reconstruction as in calculate_rdc_amide_large
+       block_size : None (default) or number of frames in a block
+       window     : None (default) or number of consecutive blocks in a sliding window.
+                    Effective only if block_size is given
+       weights, dtrajs : weights of frames, see calculate_rdc_large
+
+    Return:
+        S2         - order parameters over the whole trajectory, numpy array with length n_bonds
+        S2_windows - None if block_size is None. Otherwise order parameters of each block
+                     (window=None) or of each sliding window of blocks, with shape (n, n_bonds)
+    """
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    restraints = engine.restraints(RDC_inp_file, amide=amide)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    accumulator = engine.accumulate(traj, restraints, weights=weights, block_size=block_size)
+    S2 = order_parameters(accumulator.average())
+    if block_size is None:
+        return(S2, None)
+    F_blocks, block_frames = accumulator.blocks()
+    if window is not None:
+        F_blocks, block_frames = sliding_block_sums(F_blocks, block_frames, window)
+    return(S2, order_parameters(F_blocks/block_frames[:, None, None]))
+####################################################################################################
+
+def j3_quartets(topology):
+    """
+    Resolve atom quartets C(i-1), N(i), CA(i), C(i) of phi dihedral angles once per topology.
+    Residues are assigned by the N atom, as in analysis.index2res.
+
+    Args:
+        topology : MDtraj topology or topology file
+
+    Return:
+        indices       - integer numpy array with shape (n_phi, 4)
+        residue_index - list of Python-numerated residue ids
+        residue_name  - list of residue names
+    """
+    if isinstance(topology, str):
+        topology = md.load_topology(topology)
+    # Dihedral atoms depend only on topology, coordinates are not used
+    indices, phi = md.compute_phi(md.Trajectory(np.zeros((1, topology.n_atoms, 3)), topology))
+    residue_index = [topology.atom(int(atom)).residue.index for atom in indices[:, 1]]
+    residue_name = [topology.atom(int(atom)).residue.name for atom in indices[:, 1]]
+    return(indices, residue_index, residue_name)
+
+
+def karplus_chunk(phi, model='Bax2007'):
+    """
+    3J(HN-HA) couplings (Hz) from phi dihedral angles (radians) of any shape,
+    J = A cos^2(phi + phi0) + B cos(phi + phi0) + C, with coefficients of
+    md.compute_J3_HN_HA for the given model ('Bax2007', 'Bax1997' or 'Ruterjans1999')
+    """
+    coefficients = md.nmr.scalar_couplings.J3_HN_HA_coefficients[model]
+    cos_phi = np.cos(phi + coefficients['phi0'])
+    return coefficients['A']*cos_phi**2 + coefficients['B']*cos_phi + coefficients['C']
+
+
+def karplus_moments_chunk(indices, xyz, model='Bax2007'):
+    """
+    Kernel of accumulate_observable for 3J(HN-HA) couplings: J and J^2 of phi dihedral
+    quartets indices (see j3_quartets) in all frames of a chunk, numpy array with shape
+    (n_frames, n_phi, 2). Use functools.partial to set indices and the model
+    """
+    phi = md.compute_dihedrals(md.Trajectory(xyz, None), indices, periodic=False)
+    J = karplus_chunk(phi, model=model)
+    return np.stack((J, J**2), axis=-1)
+
+
+def calculate_j3(traj, topology, model='Bax2007', chunk_size=5000, n_jobs=1, weights=None, dtrajs=None):
+    """
+    Calculate 3J(HN-HA) couplings, averaged over a long trajectory, reading it once in chunks.
+    Phi dihedral quartets are resolved once, and couplings of each chunk are computed from
+    vectorized dihedrals.
+
+    Args:
+       traj       : trajectory file or list of files (replicas), treated as one trajectory
+       topology   : topology file
+       model      : Karplus coefficients, see karplus_chunk
+       chunk_size : number of frames, read at once (default 5000)
+       n_jobs     : number of worker processes (default 1)
+       weights, dtrajs : weights of frames, see frame_weights
+
+    Return:
+        residue_index - list of Python-numerated residue ids (the same as analysis.index2res)
+        residue_name  - list of residue names
+        J_av          - numpy array with (weighted) average couplings of residues, Hz
+        J_std         - numpy array with standard deviations of couplings over frames, Hz
+    """
+    indices, residue_index, residue_name = j3_quartets(topology)
+    if weights is not None:
+        weights = frame_weights(weights, dtrajs)
+    engine = NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    accumulator, scratch_files = engine.accumulate_observable(traj, functools.partial(karplus_moments_chunk, indices,
+                                                                                      model=model),
+                                                              len(indices), n_components=2, weights=weights)
+    J_av, J2_av = accumulator.average().T
+    return(residue_index, residue_name, J_av, np.sqrt(np.maximum(J2_av - J_av**2, 0)))
 ####################################################################################################
@@ -0,0 +1,218 @@
+import numpy as np
+import re
+import functools
+import mdtraj as md
+from . import md_nmr2
+
+########################################################################################
+#
+#   The module contains classes and functions needed to calculate NMR distance
+#   observables (NOE, PRE) from long md traj trajectories.
+#   Trajectories are read in chunks, so they are never loaded in memory as a whole.
+#
+#   Running sums of r^-6 and r^-3 are accumulated by md_nmr2.NMREngine.accumulate_observable
+#   with inverse_distances_chunk kernel (two components instead of five bilinear terms),
+#   so weights, blocks and parallel reduction work the same way as for RDCs.
+#
+############################################################################################
+NOE_LINE = re.compile(r'^\s*(?P<resid_i>[0-9]+)'
+                      r'\s+(?P<resname_i>[A-Z]{3})'
+                      r'\s+(?P<name_i>[A-Z0-9\#]{1,4})'
+                      r'\s+(?P<resid_j>[0-9]+)'
+                      r'\s+(?P<resname_j>[A-Z]{3})'
+                      r'\s+(?P<name_j>[A-Z0-9\#]{1,4})'
+                      r'\s+(?P<lower>[0-9\.]+)'
+                      r'\s+(?P<upper>[0-9\.]+)')
+
+
+class DistanceRestraintSet:
+    """
+    Experimental distance restraints (NOE or PRE), parsed from the input file once,
+    with atom indexes resolved for a given topology. Objects are picklable.
+
+    Args:
+        restraint_file : file with distance restraints. The format is close to the
+                         RDC input file (see md_nmr2.calculate_rdc):
+
+                      Coulumn descriptions:
+                      1:  Residue i id
+                      2:  Residue i name
+                      3:  Atom    i name
+                      4:  Residue j id
+                      5:  Residue j name
+                      6:  Atom    j name
+                      7:  Lower bound, Angstrom
+                      8:  Upper bound, Angstrom
+
+                      Atom name, ending with '#', is a group of equivalent atoms, e.g. HB#
+                      for HB2 and HB3 (or the methyl group HG2# of Ile). Contributions of all
+                      pairs of a restraint are summed (r^-6 sum averaging).
+                      For PRE, one of the atoms is the paramagnetic center of the spin label.
+
+        topology       : MDtraj topology or topology file
+
+    Attributes:
+        bonds       : list of md_nmr2.Bond objects
+        lower       : numpy array with lower bounds, Angstrom
+        upper       : numpy array with upper bounds, Angstrom
+        atom_pairs  : integer numpy array with shape (n_pairs, 2), pairs of atoms of all
+                      restraints, pairs of the same restraint are consecutive
+        pair_starts : index of the first pair of each restraint in atom_pairs
+    """
+
+    def __init__(self, restraint_file, topology):
+        if isinstance(topology, str):
+            topology = md.load_topology(topology)
+        self.bonds = []
+        lower = []
+        upper = []
+        with open(restraint_file, 'r') as restraint_input:
+            for line in restraint_input:
+                match = NOE_LINE.search(line)
+                if match is None:
+                    continue
+                fields = line.split()
+                lower.append(float(fields[6]))
+                upper.append(float(fields[7]))
+                self.bonds.append(md_nmr2.Bond(int(fields[0]), fields[1], fields[2],
+                                               int(fields[3]), fields[4], fields[5]))
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+
+        residue_atoms = {}
+        for atom in topology.atoms:
+            residue_atoms.setdefault(atom.residue.index, []).append(atom)
+
+        # -1 correspond to transition between PDB numeration and MDTRAJ numeration
+        atom_pairs = []
+        pair_starts = []
+        for bond in self.bonds:
+            atoms_i = self.find_atoms(residue_atoms, bond.resid_i-1, bond.atomname_i)
+            atoms_j = self.find_atoms(residue_atoms, bond.resid_j-1, bond.atomname_j)
+            pair_starts.append(len(atom_pairs))
+            atom_pairs += [[i, j] for i in atoms_i for j in atoms_j]
+        self.atom_pairs = np.array(atom_pairs, dtype=int).reshape(-1, 2)
+        self.pair_starts = np.array(pair_starts, dtype=int)
+
+    @staticmethod
+    def find_atoms(residue_atoms, residue_index, name):
+        if name.endswith('#'):
+            atoms = [atom.index for atom in residue_atoms.get(residue_index, [])
+                     if atom.name.startswith(name[:-1])]
+        else:
+            atoms = [atom.index for atom in residue_atoms.get(residue_index, []) if atom.name == name]
+            atoms = atoms[:1]
+        assert len(atoms) > 0, "Atom %s of residue %i is not found in topology" % (name, residue_index+1)
+        return atoms
+
+    def __len__(self):
+        return len(self.bonds)
+
+
+def load_distance_restraints(restraint_file, topology):
+    """
+    Return DistanceRestraintSet for a given input file and topology.
+    If restraint_file is already a DistanceRestraintSet, it is returned as is.
+    """
+    if isinstance(restraint_file, DistanceRestraintSet):
+        return restraint_file
+    return DistanceRestraintSet(restraint_file, topology)
+
+#####################################################################################################
+def inverse_distances_chunk(restraints, xyz):
+    """
+    Calculate r^-6 and r^-3 of all restraints in all frames of a chunk.
+
+    Input:   restraints - DistanceRestraintSet
+             xyz        - coordinates (nm), numpy array with shape (n_frames, n_atoms, 3)
+
+    Output:  numpy array with shape (n_frames, n_restraints, 2), distances in Angstrom.
+             [..., 0] - r^-6, summed over all pairs of a restraint
+             [..., 1] - r^-3 of the effective distance (sum r^-6)^(-1/6) of a frame
+    """
+    pairs = restraints.atom_pairs
+    vec = np.subtract(xyz[:, pairs[:, 1], :], xyz[:, pairs[:, 0], :], dtype=np.float64)
+    r2 = np.einsum('fpa,fpa->fp', vec, vec)*100.0
+    r6 = np.add.reduceat(r2**-3, restraints.pair_starts, axis=1)
+    return np.stack((r6, np.sqrt(r6)), axis=-1)
+
+#####################################################################################################
+def noe_distances(R_av):
+    """
+    Effective distances from averaged inverse distance powers, vectorized over leading axes.
+
+    Args:
+        R_av : numpy array with shape (..., n_restraints, 2), averaged r^-6 and r^-3
+
+    Return:
+        r6 - <r^-6>^(-1/6), Angstrom (NOE with fast internal motion, PRE)
+        r3 - <r^-3>^(-1/3), Angstrom (NOE with slow internal motion)
+    """
+    return(R_av[..., 0]**(-1.0/6), R_av[..., 1]**(-1.0/3))
+
+
+def noe_violations(restraints, distances):
+    """
+    Violations of restraint bounds, vectorized over leading axes of distances:
+    positive values - distance above the upper bound, negative - below the lower bound,
+    zero - within the bounds (Angstrom).
+    """
+    return(np.maximum(distances - restraints.upper, 0) - np.maximum(restraints.lower - distances, 0))
+
+
+def calculate_noe(traj, topology, restraint_file, chunk_size=5000, n_jobs=1, weights=None, dtrajs=None):
+    """
+    Calculate <r^-6> and <r^-3> averaged distances of NOE/PRE restraints and their
+    violations, reading a long trajectory once in chunks.
+
+    Args:
+       traj           : trajectory file or list of files (replicas), treated as one trajectory
+       topology       : topology file
+       restraint_file : file with distance restraints or DistanceRestraintSet
+       chunk_size     : number of frames, read at once (default 5000).
+                        Peak memory is bounded by the size of a chunk.
+       n_jobs         : number of worker processes (default 1)
+       weights, dtrajs: weights of frames, see md_nmr2.frame_weights
+
+    Return: three numpy arrays:
+              r6         - <r^-6>^(-1/6), Angstrom
+              r3         - <r^-3>^(-1/3), Angstrom
+              violations - violations of bounds by r6, see noe_violations
+    """
+    restraints = load_distance_restraints(restraint_file, topology)
+    if weights is not None:
+        weights = md_nmr2.frame_weights(weights, dtrajs)
+    engine = md_nmr2.NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    accumulator, scratch_files = engine.accumulate_observable(traj, functools.partial(inverse_distances_chunk,
+                                                                                      restraints),
+                                                              len(restraints), n_components=2, weights=weights)
+    r6, r3 = noe_distances(accumulator.average())
+    return(r6, r3, noe_violations(restraints, r6))
+
+
+def calculate_noe_blocks(traj, topology, restraint_file, block_size, chunk_size=5000, n_jobs=1,
+                         weights=None, dtrajs=None):
+    """
+    Read a long trajectory once and return sums of r^-6 and r^-3 over consecutive blocks
+    of frames. Distances of block (or combined blocks) averages are obtained by
+    noe_distances(R_blocks/block_frames[:, None, None]).
+
+    Args: see calculate_noe
+       block_size : number of frames in a block
+
+    Return:
+        restraints   - DistanceRestraintSet
+        R_blocks     - sums with shape (n_blocks, n_restraints, 2)
+        block_frames - numbers of frames in blocks (sums of weights, if frames are weighted)
+    """
+    restraints = load_distance_restraints(restraint_file, topology)
+    if weights is not None:
+        weights = md_nmr2.frame_weights(weights, dtrajs)
+    engine = md_nmr2.NMREngine(topology, chunk_size=chunk_size, n_jobs=n_jobs)
+    accumulator, scratch_files = engine.accumulate_observable(traj, functools.partial(inverse_distances_chunk,
+                                                                                      restraints),
+                                                              len(restraints), n_components=2, block_size=block_size,
+                                                              weights=weights)
+    R_blocks, block_frames = accumulator.blocks()
+    return(restraints, R_blocks, block_frames)
+####################################################################################################
@@ -1,4 +1,8 @@
 import numpy as np
+import os
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
 import mdtraj as md
 
 def superpose(traj_ref):
@@ -29,7 +33,7 @@ def superpose(traj_ref):
         
     for i in range (0,N_frame):
         for j in range (i,N_frame):
-            res = md.rmsd((traj_alpha[i]),(traj_alpha[j]))
+            res = md.rmsd((traj_alpha[i]),(traj_alpha[j]))[0]
             RMSD[i,j] = res
             RMSD[j,i] = res
 
@@ -39,10 +43,18 @@ def superpose(traj_ref):
     traj_ref.superpose(traj_ref, frame=min_idx)
     return(traj_ref)
 
-def superpose2(traj_ref):
+def superpose2(traj_ref, n_jobs=1, approximate=False, n_candidates=None, tol=0.0, seed=None, cache_dir=None):
 
     """ The function creates a trajectory, superimposed with respect to the frame,
         minimizing sum of Calpha RMSD with respect to all other frames.
+        The result is the same as of superpose, but C-alpha coordinates are centered once
+        and each row of RMSD matrix is computed with a single md.rmsd call (see find_medoid).
+        Rows are evaluated by n_jobs processes.
+
+        If approximate=True, the frame is found by approximate_medoid with parameters
+        n_candidates, tol and seed, which avoids computing the whole RMSD matrix, and
+        the function returns (traj_ref, error_bound, n_evaluations), see approximate_medoid.
+        Otherwise, if cache_dir is given, the C-alpha RMSD matrix is cached there (see pairwise_rmsd).
 
 
        IMPORTANT NOTE: for current version to work, need to use a trajectory, that can be loaded
@@ -50,28 +62,23 @@ def superpose2(traj_ref):
     """
     
 
-    keep = [a.index for a in traj_ref.topology.atoms if a.name == 'CA']
-    traj_alpha = traj_ref.atom_slice(atoms_to_keep)
+    keep = alpha_indices(traj_ref.topology)
+    traj_alpha = traj_ref.atom_slice(keep)
     
     
     # According to the procedure, described in Olsson2017 papper, need to find a frame, 
     # which minimizes sum of  C_alpha RMSD with respect to all other frames
-    # Quadratic algorithm  (O(N2))???
-    # Should use C-alpha trajectory!
-    #  RMSD matrix is symmetric 
+    # Quadratic algorithm, but O(N) calls of md.rmsd
     
-    min_idx = 0  
-    
-    N_frame = traj_ref.n_frames
-    RMSD = np.zeros(N_frame)
-        
-    for i in range (0,N_frame):
-            res = md.rmsd(traj_alpha,traj_alpha[i])
-            RMSD[i] = np.sum(res)
-
-    min_idx = np.argmin(RMSD)
+    if approximate:
+        min_idx, min_sum, error_bound, n_evaluations = approximate_medoid(traj_alpha, n_candidates=n_candidates,
+                                                                          tol=tol, seed=seed)
+    else:
+        min_idx, sum_RMSD = find_medoid(traj_alpha, n_jobs=n_jobs, cache_dir=cache_dir)
     
     traj_ref.superpose(traj_ref, frame=min_idx)
+    if approximate:
+        return(traj_ref, error_bound, n_evaluations)
     return(traj_ref)
 
 
@@ -109,42 +116,537 @@ def superpose3(traj_ref,topology):
 
 
 
-def superpose_large(traj,frames):
+def superpose_mean(traj_ref, max_iter=50, tol=1e-5):
+
+    """ The function creates a trajectory, superimposed with respect to the mean C-alpha
+        structure, found iteratively (see mean_structure). Each iteration is a single O(N)
+        pass, so it can be used for trajectories, too long for the medoid search of superpose.
+
+       IMPORTANT NOTE: for current version to work, need to use a trajectory, that can be loaded
+                       in memory at once, not in chunks. See superpose_large(method='mean')
+
+       Returns: traj_ref - superimposed trajectory
+                mean - single-frame MDtraj trajectory with the mean C-alpha structure
+    """
+    keep = alpha_indices(traj_ref.topology)
+    mean, n_iter = mean_structure(traj_ref.atom_slice(keep), max_iter=max_iter, tol=tol)
+    traj_ref.superpose(mean, 0, atom_indices=keep, ref_atom_indices=np.arange(mean.n_atoms))
+    return(traj_ref, mean)
+
+
+def mean_structure(traj_alpha, max_iter=50, tol=1e-5):
+    """ Iterative mean structure: all frames are superimposed on the reference (the first frame
+        at the beginning), the mean structure of aligned frames becomes the new reference, and
+        this is repeated until RMSD between successive mean structures is below tol (nm).
+        Successive means are in the same frame, so RMSD is computed without superposition
+        (md.rmsd is not accurate for almost identical structures).
+
+        Args: traj_alpha: MDtraj trajectory (usually only C-alpha atoms)
+              max_iter: maximal number of iterations (default 50)
+              tol: convergence threshold, nm (default 1e-5)
+
+        Returns: mean - single-frame MDtraj trajectory with the mean structure
+                 n_iter - number of iterations
+    """
+    aligned = md.Trajectory(traj_alpha.xyz.copy(), traj_alpha.topology)
+    reference = aligned[0]
+    for n_iter in range(1, max_iter + 1):
+        # frames, aligned at the previous iteration, are superimposed again
+        aligned.superpose(reference, 0)
+        mean = md.Trajectory(np.mean(aligned.xyz, axis=0, dtype=np.float64)[None].astype(np.float32),
+                             traj_alpha.topology)
+        change = np.sqrt(np.mean(np.sum((mean.xyz[0] - reference.xyz[0])**2, axis=-1, dtype=np.float64)))
+        reference = mean
+        if change < tol:
+            break
+    return(reference, n_iter)
+
+
+def mean_structure_large(traj, topology, max_iter=50, tol=1e-5, chunk_size=5000):
+    """ Streaming version of mean_structure for C-alpha atoms of trajectory file(s), that
+        cannot be loaded in memory. Each iteration is one pass over the trajectory in chunks,
+        memory is bounded by chunk_size.
+
+        Args: traj: trajectory file or list of files, treated as one trajectory
+              topology: topology file
+              max_iter, tol: see mean_structure
+              chunk_size: number of frames, read at once
+
+        Returns: mean - single-frame MDtraj trajectory with the mean C-alpha structure
+                 n_iter - number of iterations (passes over the trajectory)
+    """
+    if isinstance(traj, str):
+        traj = [traj]
+    keep = alpha_indices(md.load_topology(topology) if isinstance(topology, str) else topology)
+    reference = md.load_frame(traj[0], 0, top=topology, atom_indices=keep)
+    for n_iter in range(1, max_iter + 1):
+        xyz_sum = np.zeros(reference.xyz.shape[1:])
+        n_frames = 0
+        for traj_file in traj:
+            for chunk in md.iterload(traj_file, chunk=chunk_size, top=topology, atom_indices=keep):
+                chunk.superpose(reference, 0)
+                xyz_sum += np.sum(chunk.xyz, axis=0, dtype=np.float64)
+                n_frames += chunk.n_frames
+        mean = md.Trajectory((xyz_sum/n_frames)[None].astype(np.float32), reference.topology)
+        change = np.sqrt(np.mean(np.sum((mean.xyz[0] - reference.xyz[0])**2, axis=-1, dtype=np.float64)))
+        reference = mean
+        if change < tol:
+            break
+    return(reference, n_iter)
+
+
+def superpose_large(traj, topology, output_file, n_samples=1000, chunk_size=5000, seed=None,
+                    approximate=False, method='medoid', max_iter=50, tol=1e-5):
 
     """ The function creates a trajectory, superimposed with respect to the frame,
         minimizing sum of Calpha RMSD with respect to all other frames.
 
 
-       This virsion streems input trajectory from file.
+       This virsion streems input trajectory from file. The reference frame is the medoid
+       of a random sample of frames (see reference_frame), then the trajectory is read again
+       chunk by chunk, each chunk is superimposed by C-alpha atoms and written to output_file.
+       Memory is bounded by chunk_size and n_samples, whatever the trajectory length.
 
-       traj - name of the input file.
-       frames - number of frames to look through for finding    
+       traj - name of the input file, or list of files, treated as one trajectory
+       topology - topology file
+       output_file - name of the output .xtc or .dcd file
+       n_samples - number of frames to look through for finding the reference (default 1000)
+       chunk_size - number of frames, read at once (default 5000)
+       seed - seed of random number generator, used for sampling
+       approximate - if True, the medoid of the sample is found by approximate_medoid
+       method - 'medoid' (default) or 'mean'. If 'mean', frames are superimposed on the
+                iterative mean C-alpha structure of the whole trajectory (see
+                mean_structure_large, parameters max_iter and tol), instead of the medoid
+
+       Returns: frame_index - index of the reference frame in the trajectory (None for method='mean')
+                n_frames - number of written frames
     """
-    
+    if isinstance(traj, str):
+        traj = [traj]
+    if method == 'mean':
+        reference, n_iter = mean_structure_large(traj, topology, max_iter=max_iter, tol=tol, chunk_size=chunk_size)
+        frame_index = None
+    else:
+        reference, frame_index = reference_frame(traj, topology, n_samples=n_samples, chunk_size=chunk_size,
+                                                 seed=seed, approximate=approximate)
+    keep = alpha_indices(md.load_topology(topology) if isinstance(topology, str) else topology)
+    n_frames = 0
+    with md.open(output_file, 'w') as output:
+        for traj_file in traj:
+            for chunk in md.iterload(traj_file, chunk=chunk_size, top=topology):
+                chunk.superpose(reference, 0, atom_indices=keep, ref_atom_indices=np.arange(reference.n_atoms))
+                write_chunk(output, output_file, chunk)
+                n_frames += chunk.n_frames
+    return(frame_index, n_frames)
 
-    keep = [a.index for a in traj_ref.topology.atoms if a.name == 'CA']
-    # traj_alpha = traj_ref.atom_slice(atoms_to_keep)
-    
-    
-    # According to the procedure, described in Olsson2017 papper, need to find a frame, 
-    # which minimizes sum of  C_alpha RMSD with respect to all other frames
-    # Quadratic algorithm  (O(N2))???
-    # Should use C-alpha trajectory!
-    #  RMSD matrix is symmetric 
-    
-    min_idx = 0  
-    
-    N_frame = traj_ref.n_frames
-    RMSD = np.zeros((N_frame,N_frame))
-        
-    for i in range(0,N_frame):
-        for j in range(i,N_frame):
-            res = md.rmsd((traj_ref.atom_slice(keep)[i]),(traj_ref.atom_slice(keep)[j]))
-            RMSD[i,j] = res
-            RMSD[j,i] = res
 
-    sum_RMSD=np.sum(RMSD,axis=0)
-    min_idx = np.argmin(sum_RMSD)
-    
-    traj_ref.superpose(traj_ref, frame=min_idx)
-    return(traj_ref)
+def write_chunk(output, output_file, chunk):
+    """ Append frames of MDtraj trajectory chunk to an open .xtc or .dcd file (md.open(..., 'w'))
+    """
+    xyz = md.utils.in_units_of(chunk.xyz, 'nanometers', output.distance_unit)
+    if output_file.endswith('.xtc'):
+        box = None
+        if chunk.unitcell_vectors is not None:
+            box = md.utils.in_units_of(chunk.unitcell_vectors, 'nanometers', output.distance_unit)
+        output.write(xyz, time=chunk.time, box=box)
+    elif output_file.endswith('.dcd'):
+        cell_lengths = None
+        if chunk.unitcell_lengths is not None:
+            cell_lengths = md.utils.in_units_of(chunk.unitcell_lengths, 'nanometers', output.distance_unit)
+        output.write(xyz, cell_lengths=cell_lengths, cell_angles=chunk.unitcell_angles)
+    else:
+        raise ValueError("Output file should be .xtc or .dcd: %s" % output_file)
+
+
+def alpha_indices(topology):
+    """ Return indexes of C-alpha atoms of MDtraj topology
+    """
+    return [a.index for a in topology.atoms if a.name == 'CA']
+
+
+RMSD_ROWS_TRAJ = None
+
+
+def init_rmsd_rows(traj_centered):
+    """ Initializer of worker processes of rmsd_row_sums: keeps precentered trajectory
+        in the worker, so that it is sent to each process only once
+    """
+    global RMSD_ROWS_TRAJ
+    RMSD_ROWS_TRAJ = traj_centered
+
+
+def rmsd_row_sums(rows, traj_centered=None):
+    """ Sums of rows of RMSD matrix of a precentered trajectory (default - the one of
+        the worker process, see init_rmsd_rows). Each row is a single md.rmsd call.
+    """
+    if traj_centered is None:
+        traj_centered = RMSD_ROWS_TRAJ
+    return np.array([np.sum(md.rmsd(traj_centered, traj_centered, i, precentered=True), dtype=np.float64)
+                     for i in rows])
+
+
+def find_medoid(traj_alpha, n_jobs=1, cache_dir=None):
+    """ The function finds the frame, minimizing sum of RMSD with respect to all other frames.
+        Coordinates are centered once, and each row of RMSD matrix is computed with a single
+        md.rmsd call on precentered coordinates.
+
+        Args: traj_alpha: MDtraj trajectory (usually only C-alpha atoms)
+              n_jobs: number of processes, evaluating rows (default 1)
+              cache_dir: None (default) or directory with cached RMSD matrices. If given,
+                         the condensed RMSD matrix is computed once by pairwise_rmsd and
+                         reused by later calls with the same coordinates
+
+        Returns: min_idx - index of the medoid frame
+                 sum_RMSD - numpy array, sum of RMSD of each frame with respect to all other frames
+    """
+    if cache_dir is not None:
+        sum_RMSD = condensed_row_sums(pairwise_rmsd(traj_alpha, n_jobs=n_jobs, cache_dir=cache_dir),
+                                      traj_alpha.n_frames)
+        return(int(np.argmin(sum_RMSD)), sum_RMSD)
+    traj_centered = md.Trajectory(traj_alpha.xyz.copy(), traj_alpha.topology)
+    traj_centered.center_coordinates()
+    if n_jobs > 1:
+        row_blocks = np.array_split(np.arange(traj_centered.n_frames), n_jobs)
+        with multiprocessing.Pool(n_jobs, initializer=init_rmsd_rows, initargs=(traj_centered,)) as pool:
+            sum_RMSD = np.concatenate(pool.map(rmsd_row_sums, row_blocks))
+    else:
+        sum_RMSD = rmsd_row_sums(range(traj_centered.n_frames), traj_centered)
+    min_idx = int(np.argmin(sum_RMSD))
+    return(min_idx, sum_RMSD)
+
+
+PAIRWISE_SHARED = None
+
+
+def init_pairwise_rmsd(shm_name, shape, topology, traces):
+    """ Initializer of worker processes of pairwise_rmsd_rows: attaches precentered coordinates
+        in shared memory, so that they are not copied to every process
+    """
+    global PAIRWISE_SHARED
+    shm = shared_memory.SharedMemory(name=shm_name)
+    PAIRWISE_SHARED = (shm, np.ndarray(shape, dtype=np.float32, buffer=shm.buf), topology, traces)
+
+
+def pairwise_rmsd_rows(rows, xyz=None, topology=None, traces=None):
+    """ Upper triangular parts d(i, i+1:) of rows of RMSD matrix of precentered coordinates xyz
+        with rmsd traces (sums of squared coordinates of frames, see center_coordinates);
+        default - the ones in shared memory, see init_pairwise_rmsd. The rows are concatenated.
+        Trajectories are built on views of xyz, with the traces of the same frames
+        (slicing a centered Trajectory would keep rmsd traces of all frames), so
+        nothing is copied or centered again
+    """
+    if xyz is None:
+        shm, xyz, topology, traces = PAIRWISE_SHARED
+    reference = md.Trajectory(xyz, topology)
+    reference._rmsd_traces = traces
+    values = [np.empty(0, dtype=np.float32)]
+    for i in rows:
+        target = md.Trajectory(xyz[i+1:], topology)
+        target._rmsd_traces = traces[i+1:]
+        values.append(md.rmsd(target, reference, i, precentered=True))
+    return np.concatenate(values)
+
+
+def coordinates_hash(xyz, atom_indices):
+    """ Return sha1 hex digest of coordinates and atom selection
+    """
+    sha = hashlib.sha1(np.asarray(atom_indices, dtype=np.int64).tobytes())
+    for frame in range(0, xyz.shape[0], 10000):
+        sha.update(np.ascontiguousarray(xyz[frame:frame+10000], dtype=np.float32).tobytes())
+    return sha.hexdigest()
+
+
+def pairwise_rmsd(traj, atom_indices=None, n_jobs=1, cache_dir=None):
+    """ The function computes RMSD between all pairs of frames, stored as a condensed
+        matrix (the same order as scipy.spatial.distance.squareform: d(0,1), d(0,2), ...,
+        d(1,2), ...), float32. Only the upper triangle is computed; rows are split into
+        blocks with equal number of pairs and computed by n_jobs processes, which read
+        the selected coordinates from shared memory.
+
+        Args: traj: MDtraj trajectory
+              atom_indices: atoms used for RMSD (default - C-alpha atoms)
+              n_jobs: number of processes (default 1)
+              cache_dir: None (default) or directory. If given, the matrix is stored there as
+                         .npy file, named by hash of coordinates and atom selection, and is
+                         returned as read-only memmap by later calls instead of recomputing it
+
+        Returns: numpy array (or memmap) with length n_frames*(n_frames-1)/2
+    """
+    if atom_indices is None:
+        atom_indices = alpha_indices(traj.topology)
+    traj_selected = traj.atom_slice(atom_indices)
+    n = traj_selected.n_frames
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'rmsd_%s.npy' % coordinates_hash(traj.xyz[:, atom_indices],
+                                                                           atom_indices))
+        if os.path.isfile(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+
+    traj_selected.center_coordinates()
+    # row i contains n-i-1 pairs; blocks of rows with approximately equal number of pairs
+    n_blocks = max(1, n_jobs*4)
+    row_starts = np.concatenate(([0], np.cumsum(np.arange(n-1, 0, -1))))
+    bounds = np.searchsorted(row_starts, np.linspace(0, row_starts[-1], n_blocks+1)[1:-1])
+    row_blocks = [rows for rows in np.split(np.arange(n), bounds) if len(rows) > 0]
+
+    if cache_file is None:
+        condensed = np.empty(n*(n-1)//2, dtype=np.float32)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.%i.tmp.npy' % os.getpid()
+        condensed = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(n*(n-1)//2,))
+
+    if n_jobs > 1:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, traj_selected.xyz.nbytes))
+        try:
+            xyz = np.ndarray(traj_selected.xyz.shape, dtype=np.float32, buffer=shm.buf)
+            xyz[:] = traj_selected.xyz
+            with multiprocessing.Pool(n_jobs, initializer=init_pairwise_rmsd,
+                                      initargs=(shm.name, xyz.shape, traj_selected.topology,
+                                                traj_selected._rmsd_traces)) as pool:
+                for rows, values in zip(row_blocks, pool.imap(pairwise_rmsd_rows, row_blocks)):
+                    condensed[row_starts[rows[0]]:row_starts[rows[0]]+len(values)] = values
+            del xyz
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        for rows in row_blocks:
+            values = pairwise_rmsd_rows(rows, traj_selected.xyz, traj_selected.topology,
+                                        traj_selected._rmsd_traces)
+            condensed[row_starts[rows[0]]:row_starts[rows[0]]+len(values)] = values
+
+    if cache_file is not None:
+        condensed.flush()
+        del condensed
+        os.replace(tmp_file, cache_file)
+        return np.load(cache_file, mmap_mode='r')
+    return condensed
+
+
+def condensed_row_sums(condensed, n_frames):
+    """ Sums of rows of a symmetric matrix, stored in condensed form (see pairwise_rmsd).
+        The condensed matrix (or memmap) is read sequentially, row by row
+    """
+    sums = np.zeros(n_frames)
+    start = 0
+    for i in range(n_frames - 1):
+        row = condensed[start:start + n_frames - i - 1]
+        sums[i] += np.sum(row, dtype=np.float64)
+        sums[i+1:] += row
+        start += n_frames - i - 1
+    return sums
+
+
+def approximate_medoid(traj_alpha, n_candidates=None, tol=0.0, seed=None):
+    """ The function finds the frame, minimizing sum of RMSD with respect to all other frames,
+        without computing the whole RMSD matrix. Candidate frames are visited in the order
+        of increasing lower bound of their sum of RMSD (random order at first), and the row
+        of RMSD matrix (single md.rmsd call) is computed only for a candidate, which can
+        still win. After each computed row d(c, .) the lower bound of the sum
+        of RMSD of every candidate i is updated with the triangle inequality:
+            sum_j d(i,j) >= sum_j |d(c,j) - d(c,i)|
+        (sorted row and prefix sums, O(N log N)). The search stops, when lower bounds of all
+        remaining candidates are not smaller than the best sum found, so with tol=0 and
+        n_candidates=None the result is the same as of find_medoid.
+
+        Args: traj_alpha: MDtraj trajectory (usually only C-alpha atoms)
+              n_candidates: None (default - all frames) or number of randomly sampled
+                            candidate frames. Sums of RMSD are always over all frames
+              tol: relative tolerance. A candidate is skipped, if its lower bound is larger
+                   than best_sum/(1 + tol)
+              seed: seed of random number generator
+
+        Returns: min_idx - index of the (approximate) medoid frame
+                 min_sum - sum of RMSD of min_idx with respect to all frames
+                 error_bound - upper bound of min_sum - (best sum among candidates),
+                               0 if the medoid of candidates was found exactly
+                 n_evaluations - number of computed RMSD values
+    """
+    rng = np.random.default_rng(seed)
+    traj_centered = md.Trajectory(traj_alpha.xyz.copy(), traj_alpha.topology)
+    traj_centered.center_coordinates()
+    n_frames = traj_centered.n_frames
+    if n_candidates is None or n_candidates >= n_frames:
+        candidates = rng.permutation(n_frames)
+    else:
+        candidates = rng.choice(n_frames, size=n_candidates, replace=False)
+    lower_bound = np.zeros(len(candidates))
+    evaluated = np.zeros(len(candidates), dtype=bool)
+    min_idx, min_sum = -1, np.inf
+    n_rows = 0
+    while not np.all(evaluated):
+        # The candidate with the smallest lower bound is visited first
+        k = int(np.argmin(np.where(evaluated, np.inf, lower_bound)))
+        if lower_bound[k]*(1 + tol) >= min_sum:
+            break
+        row = md.rmsd(traj_centered, traj_centered, int(candidates[k]), precentered=True).astype(np.float64)
+        n_rows += 1
+        evaluated[k] = True
+        row_sum = np.sum(row)
+        lower_bound[k] = row_sum
+        if row_sum < min_sum:
+            min_idx, min_sum = int(candidates[k]), row_sum
+        # sum_j |d_j - d_i| for every candidate i from the sorted row
+        sorted_row = np.sort(row)
+        prefix = np.concatenate(([0.0], np.cumsum(sorted_row)))
+        d = row[candidates]
+        m = np.searchsorted(sorted_row, d)
+        bound = d*m - prefix[m] + (prefix[-1] - prefix[m]) - d*(n_frames - m)
+        lower_bound = np.where(evaluated, lower_bound, np.maximum(lower_bound, bound))
+    remaining = lower_bound[~evaluated]
+    error_bound = 0.0 if len(remaining) == 0 else max(0.0, min_sum - np.min(remaining))
+    return(min_idx, float(min_sum), float(error_bound), n_rows*n_frames)
+
+
+def sample_alpha_frames(traj, topology, n_samples=1000, chunk_size=5000, seed=None):
+    """ The function draws a uniform random sample of C-alpha frames from trajectory file(s),
+        reading them once in chunks (reservoir sampling). Memory does not depend on the
+        length of the trajectory.
+
+        Args: traj: trajectory file or list of files, treated as one trajectory
+              topology: topology file
+              n_samples: size of the sample (default 1000). If the trajectory is shorter,
+                         all frames are returned
+              chunk_size: number of frames, read at once
+              seed: seed of random number generator
+
+        Returns: sample - MDtraj trajectory with C-alpha atoms of sampled frames, ordered by frame index
+                 frame_indexes - numpy array, index of each sampled frame in the whole trajectory
+                 n_frames - total number of frames in the trajectory
+    """
+    if isinstance(traj, str):
+        traj = [traj]
+    rng = np.random.default_rng(seed)
+    keep = alpha_indices(md.load_topology(topology) if isinstance(topology, str) else topology)
+    reservoir = None
+    frame_indexes = np.empty(n_samples, dtype=int)
+    n_frames = 0
+    for traj_file in traj:
+        for chunk in md.iterload(traj_file, chunk=chunk_size, top=topology, atom_indices=keep):
+            if reservoir is None:
+                reservoir = np.empty((n_samples,) + chunk.xyz.shape[1:], dtype=chunk.xyz.dtype)
+                alpha_topology = chunk.topology
+            chunk_indexes = n_frames + np.arange(chunk.n_frames)
+            # Fill the reservoir first, then replace a random element with probability n_samples/(t+1)
+            n_fill = max(0, min(n_samples - n_frames, chunk.n_frames))
+            reservoir[n_frames:n_frames+n_fill] = chunk.xyz[:n_fill]
+            frame_indexes[n_frames:n_frames+n_fill] = chunk_indexes[:n_fill]
+            slots = rng.integers(0, chunk_indexes[n_fill:] + 1)
+            replace = np.nonzero(slots < n_samples)[0]
+            # If a slot is drawn twice within a chunk, the later frame wins
+            slots, last = np.unique(slots[replace][::-1], return_index=True)
+            replace = replace[::-1][last] + n_fill
+            reservoir[slots] = chunk.xyz[replace]
+            frame_indexes[slots] = chunk_indexes[replace]
+            n_frames += chunk.n_frames
+
+    n_kept = min(n_samples, n_frames)
+    order = np.argsort(frame_indexes[:n_kept])
+    sample = md.Trajectory(reservoir[:n_kept][order], alpha_topology)
+    return(sample, frame_indexes[:n_kept][order], n_frames)
+
+
+def reference_frame(traj, topology, n_samples=1000, chunk_size=5000, seed=None, approximate=False):
+    """ The function finds a reference frame for superposition of a trajectory, that cannot be
+        loaded in memory: C-alpha atoms of n_samples random frames are collected in a single
+        pass (sample_alpha_frames), and the frame, minimizing sum of C-alpha RMSD with respect
+        to all other sampled frames, is chosen (find_medoid, or approximate_medoid if
+        approximate=True).
+
+        Returns: reference - single-frame MDtraj trajectory with C-alpha atoms of the reference frame
+                 frame_index - index of the reference frame in the trajectory
+    """
+    sample, frame_indexes, n_frames = sample_alpha_frames(traj, topology, n_samples=n_samples,
+                                                          chunk_size=chunk_size, seed=seed)
+    if approximate:
+        min_idx, min_sum, error_bound, n_evaluations = approximate_medoid(sample, seed=seed)
+    else:
+        min_idx, sum_RMSD = find_medoid(sample)
+    return(sample[min_idx], int(frame_indexes[min_idx]))
+
+
+def align_replica(task):
+    """ Worker function of superpose_replicas: superimposes frames of a trajectory file on the
+        reference chunk by chunk, writes them to the output file and returns numpy array with
+        C-alpha RMSD of each frame with respect to the reference.
+        task is a dictionary with keys traj, output_file, topology, reference, chunk_size.
+    """
+    reference = task['reference']
+    topology = task['topology']
+    keep = alpha_indices(md.load_topology(topology) if isinstance(topology, str) else topology)
+    ref_atoms = np.arange(reference.n_atoms)
+    rmsd = []
+    with md.open(task['output_file'], 'w') as output:
+        for chunk in md.iterload(task['traj'], chunk=task['chunk_size'], top=topology):
+            chunk.superpose(reference, 0, atom_indices=keep, ref_atom_indices=ref_atoms)
+            rmsd.append(md.rmsd(chunk, reference, 0, atom_indices=keep, ref_atom_indices=ref_atoms))
+            write_chunk(output, task['output_file'], chunk)
+    return np.concatenate(rmsd + [np.empty(0, dtype=np.float32)])
+
+
+def superpose_replicas(traj_list, topology, output_files=None, reference='medoid', n_samples=1000,
+                       chunk_size=5000, n_jobs=1, seed=None, summary_file=None):
+    """ The function superimposes many trajectories (e.g. replicas of odem runs,
+        iteration_<n>/<T>/traj.xtc) on the same reference by C-alpha atoms. Each trajectory
+        is streamed chunk by chunk from the input file to the output file, trajectories are
+        processed by n_jobs processes.
+
+        Args: traj_list: list of trajectory files
+              topology: topology file, the same for all trajectories
+              output_files: list of output .xtc or .dcd files (default - input file name
+                            with suffix _aligned, e.g. traj_aligned.xtc)
+              reference: 'medoid' (default) - medoid of n_samples frames, sampled from all
+                                              trajectories together (see reference_frame);
+                         'mean' - iterative mean C-alpha structure of all trajectories
+                                  (see mean_structure_large);
+                         name of a structure file (e.g. pdb) - its first frame;
+                         MDtraj trajectory - its first frame;
+                         tuple (trajectory index, frame index) - the frame of traj_list
+              n_samples, seed: sampling of frames for reference='medoid'
+              chunk_size: number of frames, read at once
+              n_jobs: number of processes (default 1)
+              summary_file: None (default) or text file, where summary is written
+
+        Returns: reference - single-frame MDtraj trajectory with C-alpha atoms of the reference
+                 rmsd - list of numpy arrays with C-alpha RMSD of each frame to the reference
+                 summary - numpy array with shape (n_trajectories, 6), columns: number of frames,
+                           mean, standard deviation, minimum, median and maximum of RMSD (nm)
+    """
+    top = md.load_topology(topology) if isinstance(topology, str) else topology
+    keep = alpha_indices(top)
+    if isinstance(reference, tuple):
+        reference = md.load_frame(traj_list[reference[0]], reference[1], top=topology, atom_indices=keep)
+    elif isinstance(reference, md.Trajectory):
+        reference = reference[0].atom_slice(alpha_indices(reference.topology))
+    elif reference == 'medoid':
+        reference, frame_index = reference_frame(traj_list, topology, n_samples=n_samples,
+                                                 chunk_size=chunk_size, seed=seed)
+    elif reference == 'mean':
+        reference, n_iter = mean_structure_large(traj_list, topology, chunk_size=chunk_size)
+    else:
+        structure = md.load_frame(reference, 0)
+        reference = structure.atom_slice(alpha_indices(structure.topology))
+    assert reference.n_atoms == len(keep), "Reference should have the same C-alpha atoms as topology"
+
+    if output_files is None:
+        output_files = ['%s_aligned%s' % os.path.splitext(traj_file) for traj_file in traj_list]
+    tasks = [dict(traj=traj_file, output_file=output_file, topology=topology, reference=reference,
+                  chunk_size=chunk_size) for traj_file, output_file in zip(traj_list, output_files)]
+    if n_jobs > 1:
+        with multiprocessing.Pool(min(n_jobs, len(tasks))) as pool:
+            rmsd = pool.map(align_replica, tasks)
+    else:
+        rmsd = [align_replica(task) for task in tasks]
+
+    summary = np.array([[len(r), np.mean(r), np.std(r), np.min(r), np.median(r), np.max(r)]
+                        if len(r) > 0 else [0] + [np.nan]*5 for r in rmsd])
+    if summary_file is not None:
+        with open(summary_file, 'w') as output:
+            output.write('# RMSD (nm) with respect to the reference\n')
+            output.write('# %8s %10s %10s %10s %10s %10s  %s\n' % ('n_frames', 'mean', 'std', 'min', 'median',
+                                                                  'max', 'trajectory'))
+            for traj_file, row in zip(traj_list, summary):
+                output.write('%10i %10.4f %10.4f %10.4f %10.4f %10.4f  %s\n' % (tuple(row) + (traj_file,)))
+    return(reference, rmsd, summary)
@@ -1,8 +1,13 @@
 from Protein_tools import pdb_mutator
 from Protein_tools import SMOG_contact_parser
 from Protein_tools import md_nmr2 as nmr
+from Protein_tools import md_noe
+from Protein_tools import md_nmr
+from Protein_tools import analysis
+from Protein_tools import superimpose
 import numpy as np
 import mdtraj as md
+import pytest
 
 
 def test_find_atoms_to_delete():
@@ -305,3 +310,623 @@ def test_calculate_rdc():
     reference = np.loadtxt('test_RDC_single_frame/dCalcA_reference_10_14_2019NMRServer.tab')
     for i in range(len(exp_rdc)):
         assert (reference[i]-dav[i]) < 0.001
+
+
+def test_bilin_matrix_chunk():
+    """
+    Chunk kernel should reproduce per-frame bilin_matrix for both
+    two-atom and C/N/CA (noH) bond selections
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')[:5]
+    pairs = [[traj.top.select('resid %i and name N' % i)[0],
+              traj.top.select('resid %i and name H' % i)[0]] for i in range(1, 6)]
+    triples = [[traj.top.select('resid %i and name C' % (i-1))[0],
+                traj.top.select('resid %i and name N' % i)[0],
+                traj.top.select('resid %i and name CA' % i)[0]] for i in range(1, 6)]
+    F_chunk = nmr.bilin_matrix_chunk(pairs, traj.xyz)
+    F_chunk_noH = nmr.bilin_matrix_chunk(triples, traj.xyz, noH=True)
+    assert F_chunk.shape == (5, 5, 5)
+    for i in range(traj.n_frames):
+        F = np.array([nmr.bilin(nmr.vector(pair, traj[i])) for pair in pairs])
+        F_noH = np.array([nmr.bilin(nmr.get_NH_vector(atoms, traj[i])) for atoms in triples])
+        assert np.allclose(F_chunk[i], F, atol=1e-5)
+        assert np.allclose(F_chunk_noH[i], F_noH, atol=1e-5)
+
+
+def test_calculate_rdc_large_chunk_size():
+    """
+    Result of calculate_rdc_large should not depend on chunk_size
+    """
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb', 'test1/experimental_data.txt')
+    exp_rdc, D_av = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='average')
+    exp_rdc_7, D_av_7 = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='average', chunk_size=7)
+    assert np.allclose(D_av, D_av_7)
+    assert np.allclose(D_av, np.loadtxt('test1/reference_calculated_average.txt'), atol=1e-4)
+
+
+def test_calculate_rdc_large_full(tmp_path):
+    """
+    One-pass mode='full' should reproduce reference values and write them to output_file
+    """
+    output_file = str(tmp_path / 'rdc_full.npy')
+    exp_rdc, D_full = nmr.calculate_rdc_large('test1/trajectory.xtc', 'test1/topology.pdb',
+                                              'test1/experimental_data.txt', minimize_rmsd=False,
+                                              mode='full', chunk_size=30, output_file=output_file)
+    reference = np.loadtxt('test1/reference_calculated_full.txt')
+    assert D_full.shape == reference.shape
+    assert np.allclose(D_full, reference, atol=1e-4)
+    assert np.array_equal(np.load(output_file), D_full)
+
+
+def test_calculate_rdc_large_parallel():
+    """
+    Parallel map-reduce over frame ranges should reproduce the serial result
+    """
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb', 'test1/experimental_data.txt')
+    exp_rdc, D_av = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='average')
+    exp_rdc, D_av_parallel = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='average',
+                                                     chunk_size=20, n_jobs=3)
+    assert np.allclose(D_av, D_av_parallel)
+
+    exp_rdc, D_full = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='full')
+    exp_rdc, D_full_parallel = nmr.calculate_rdc_large(*args, minimize_rmsd=False, mode='full',
+                                                       chunk_size=20, n_jobs=3)
+    assert np.allclose(D_full, D_full_parallel)
+
+    # Two identical replicas give the same average and twice as many frames
+    replicas = ['test1/trajectory.xtc', 'test1/trajectory.xtc']
+    exp_rdc, D_replicas = nmr.calculate_rdc_large(replicas, *args[1:], minimize_rmsd=False,
+                                                  mode='full', n_jobs=4)
+    assert np.allclose(D_replicas, np.concatenate([D_full, D_full]))
+    assert nmr.trajectory_segments(replicas, n_segments=4) == [('test1/trajectory.xtc', 0, 50),
+                                                               ('test1/trajectory.xtc', 50, 100),
+                                                               ('test1/trajectory.xtc', 0, 50),
+                                                               ('test1/trajectory.xtc', 50, 100)]
+
+
+def test_rdc_restraint_set(tmp_path):
+    """
+    RDCRestraintSet resolves the same atoms as topology selections,
+    is cached on disk and can be used instead of RDC_inp_file
+    """
+    top = md.load_topology('test1/topology.pdb')
+    RDC_inp_file = 'test1/experimental_data.txt'
+    restraints = nmr.RDCRestraintSet(RDC_inp_file, top)
+    for bond, (i, j) in zip(restraints.bonds, restraints.bond_selections):
+        assert i == top.select('resid %i and name %s' % (bond.resid_i-1, bond.atomname_i))[0]
+        assert j == top.select('resid %i and name %s' % (bond.resid_j-1, bond.atomname_j))[0]
+    amide = nmr.RDCRestraintSet(RDC_inp_file, top, amide=True)
+    assert amide.bond_selections.shape == (len(restraints), 3)
+
+    cached = nmr.load_restraints(RDC_inp_file, 'test1/topology.pdb', cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = nmr.load_restraints(RDC_inp_file, 'test1/topology.pdb', cache_dir=str(tmp_path))
+    assert np.array_equal(cached.bond_selections, restraints.bond_selections)
+    assert np.array_equal(cached.RDCs, restraints.RDCs)
+
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb')
+    exp_rdc, D_av = nmr.calculate_rdc_large(*args, RDC_inp_file, minimize_rmsd=False)
+    exp_rdc_set, D_av_set = nmr.calculate_rdc_large(*args, cached, minimize_rmsd=False)
+    assert np.array_equal(exp_rdc, exp_rdc_set)
+    assert np.array_equal(D_av, D_av_set)
+
+
+def test_calculate_rdc_multi(tmp_path):
+    """
+    Fitting several media in one pass should give the same result as separate runs
+    """
+    lines = open('test1/experimental_data.txt').readlines()
+    second_medium = str(tmp_path / 'second_medium.txt')
+    with open(second_medium, 'w') as output:
+        output.writelines(lines[:2] + lines[10:40])
+    media = ['test1/experimental_data.txt', second_medium]
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb')
+    for mode in ['average', 'full']:
+        exp_rdc, D_av, A_av = nmr.calculate_rdc_multi(*args, media, mode=mode, chunk_size=30)
+        assert len(D_av) == 2 and len(A_av) == 2
+        for i, medium in enumerate(media):
+            exp_rdc_single, D_single = nmr.calculate_rdc_large(*args, medium, minimize_rmsd=False, mode=mode)
+            assert np.array_equal(exp_rdc[i], exp_rdc_single)
+            assert np.allclose(D_av[i], D_single)
+    restraint_sets = [nmr.load_restraints(medium, 'test1/topology.pdb') for medium in media]
+    union, bond_indexes = nmr.RDCRestraintSet.union(restraint_sets)
+    assert len(union) == len(restraint_sets[0])
+    for restraints, bond_index in zip(restraint_sets, bond_indexes):
+        assert np.array_equal(union.bond_selections[bond_index], restraints.bond_selections)
+        assert [vars(union.bonds[i]) for i in bond_index] == [vars(bond) for bond in restraints.bonds]
+
+
+def test_rdc_blocks():
+    """
+    Block sums should add up to the total, and the last point of the convergence
+    curve should be the fit of the whole trajectory
+    """
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb', 'test1/experimental_data.txt')
+    exp_rdc, D_av = nmr.calculate_rdc_large(*args, minimize_rmsd=False)
+    exp_rdc, F_blocks, block_frames = nmr.calculate_rdc_blocks(*args, block_size=15, chunk_size=20)
+    assert np.array_equal(block_frames, [15]*6 + [10])
+    exp_rdc, F_blocks_parallel, block_frames_parallel = nmr.calculate_rdc_blocks(*args, block_size=15,
+                                                                                 n_jobs=3)
+    assert np.allclose(F_blocks, F_blocks_parallel)
+    assert np.array_equal(block_frames, block_frames_parallel)
+
+    n_frames, Q, A = nmr.rdc_convergence(exp_rdc, F_blocks, block_frames)
+    A_av, D = nmr.fit_alignment_tensor(np.sum(F_blocks, axis=0)/100, exp_rdc)
+    assert n_frames[-1] == 100
+    assert np.allclose(D, D_av)
+    assert np.allclose(A[-1], A_av)
+
+    Q_av, Q_error, A_av, A_error = nmr.rdc_block_average(exp_rdc, F_blocks, block_frames)
+    assert np.isclose(Q_av, Q[-1])
+    Q_interval, A_interval, Q_samples = nmr.rdc_bootstrap(exp_rdc, F_blocks, block_frames,
+                                                          n_bootstrap=200, seed=1)
+    assert Q_interval[0] <= Q_interval[1]
+    assert Q_samples.shape == (200,)
+
+
+def test_calculate_rdc_large_minimize_rmsd():
+    """
+    Streaming reference selection: if all frames are sampled, the reference is the exact
+    C-alpha medoid, and the result is the same as for calculate_rdc with minimize_rmsd=True.
+    With the default seed, sampling of longer trajectories is reproducible
+    """
+    from Protein_tools import superimpose
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    alpha = superimpose.alpha_indices(traj.topology)
+    sample, frame_indexes, n_frames = superimpose.sample_alpha_frames('test1/trajectory.xtc',
+                                                                     'test1/topology.pdb',
+                                                                     n_samples=10, chunk_size=7, seed=0)
+    assert n_frames == 100
+    assert len(np.unique(frame_indexes)) == 10
+    assert np.array_equal(sample.xyz, traj.xyz[frame_indexes][:, alpha])
+
+    exp_rdc, D_reference = nmr.calculate_rdc(traj, 'test1/experimental_data.txt', minimize_rmsd=True)
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb', 'test1/experimental_data.txt')
+    exp_rdc, D_av = nmr.calculate_rdc_large(*args, minimize_rmsd=True, n_reference_samples=100, chunk_size=30)
+    assert np.allclose(D_av, D_reference, atol=1e-4)
+
+    D_sampled = [nmr.calculate_rdc_large(*args, minimize_rmsd=True, n_reference_samples=10, chunk_size=30)[1]
+                 for repeat in range(3)]
+    assert all(np.array_equal(D_sampled[0], D) for D in D_sampled[1:])
+
+
+def test_calculate_rdc_large_state_file(tmp_path):
+    """
+    Adding a new segment to a saved state should give the same result as
+    processing all segments at once, and processed files should be skipped
+    """
+    import shutil
+    segment_1 = str(tmp_path / 'segment_1.xtc')
+    segment_2 = str(tmp_path / 'segment_2.xtc')
+    shutil.copy('test1/trajectory.xtc', segment_1)
+    md.load('test1/trajectory.xtc', top='test1/topology.pdb')[:40].save_xtc(segment_2)
+    state_file = str(tmp_path / 'state.pkl')
+    args = ('test1/topology.pdb', 'test1/experimental_data.txt')
+    exp_rdc, D_all = nmr.calculate_rdc_large([segment_1, segment_2], *args, minimize_rmsd=False)
+
+    nmr.calculate_rdc_large(segment_1, *args, minimize_rmsd=False, state_file=state_file)
+    exp_rdc, D_resumed = nmr.calculate_rdc_large([segment_1, segment_2], *args, minimize_rmsd=False,
+                                                 state_file=state_file)
+    assert np.allclose(D_all, D_resumed)
+    state = nmr.AccumulatorState.load(state_file)
+    assert state.accumulator.n_of_frames == 140
+    assert state.new_files([segment_1, segment_2]) == []
+
+    # segment_2 is extended in place (as by mdrun -append): only new frames are read
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    traj[40:70].save_xtc(str(tmp_path / 'extension.xtc'))
+    with open(segment_2, 'ab') as output, open(str(tmp_path / 'extension.xtc'), 'rb') as extension:
+        output.write(extension.read())
+    assert state.new_files([segment_1, segment_2]) == [(segment_2, 40)]
+    exp_rdc, D_all = nmr.calculate_rdc_large([segment_1, segment_2], *args, minimize_rmsd=False)
+    exp_rdc, D_resumed = nmr.calculate_rdc_large([segment_1, segment_2], *args, minimize_rmsd=False,
+                                                 state_file=state_file)
+    assert np.allclose(D_all, D_resumed)
+    assert nmr.AccumulatorState.load(state_file).accumulator.n_of_frames == 170
+    traj[:70].save_xtc(segment_1)
+    with pytest.raises(ValueError):
+        nmr.calculate_rdc_large([segment_1, segment_2], *args, minimize_rmsd=False, state_file=state_file)
+
+    exp_rdc, F_blocks, block_frames = nmr.calculate_rdc_blocks([segment_1, segment_2], *args, block_size=30)
+    nmr.calculate_rdc_blocks(segment_1, *args, block_size=30, state_file=state_file + '.blocks')
+    exp_rdc, F_blocks_resumed, block_frames_resumed = nmr.calculate_rdc_blocks([segment_1, segment_2], *args,
+                                                                               block_size=30,
+                                                                               state_file=state_file + '.blocks')
+    assert np.array_equal(block_frames, block_frames_resumed)
+    assert np.allclose(F_blocks, F_blocks_resumed)
+
+
+def test_calculate_rdc_weights():
+    """
+    Weighted averages: streaming and in-memory versions agree, 0/1 weights select
+    frames, per-microstate weights average over microstates
+    """
+    RDC_inp_file = 'test1/experimental_data.txt'
+    args = ('test1/trajectory.xtc', 'test1/topology.pdb', RDC_inp_file)
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    weights = np.zeros(100)
+    weights[20:60] = 1.0
+    exp_rdc, D_subset = nmr.calculate_rdc(traj[20:60], RDC_inp_file, minimize_rmsd=False)
+    exp_rdc, D_weighted = nmr.calculate_rdc_large(*args, minimize_rmsd=False, weights=weights,
+                                                  chunk_size=15, n_jobs=3)
+    assert np.allclose(D_subset, D_weighted)
+
+    dtrajs = np.arange(100) // 25
+    pi = np.array([0.1, 0.2, 0.3, 0.4])
+    restraints = nmr.RDCRestraintSet(RDC_inp_file, traj.topology)
+    F_frames = nmr.bilin_matrix_chunk(restraints.bond_selections, traj.xyz)
+    F_av = sum(p*np.mean(F_frames[dtrajs == state], axis=0) for state, p in enumerate(pi))
+    A, D_reference = nmr.fit_alignment_tensor(F_av, exp_rdc)
+    exp_rdc, D_msm = nmr.calculate_rdc_large(*args, minimize_rmsd=False, weights=pi, dtrajs=dtrajs)
+    exp_rdc, D_msm_memory = nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False, weights=pi,
+                                              dtrajs=dtrajs)
+    assert np.allclose(D_msm, D_reference)
+    assert np.allclose(D_msm_memory, D_reference)
+
+
+def test_calculate_rdc_states():
+    """
+    Per-microstate RDCs should match fits to the frames of each microstate
+    """
+    RDC_inp_file = 'test1/experimental_data.txt'
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    dtrajs = np.arange(100) % 3
+    dtrajs[dtrajs == 2] = 3  # microstate 2 is empty
+    exp_rdc, D_states, populations, A = nmr.calculate_rdc_states('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                                 RDC_inp_file, dtrajs, fit='state',
+                                                                 chunk_size=30, n_jobs=2)
+    assert np.allclose(populations, [0.34, 0.33, 0.0, 0.33])
+    assert np.all(np.isnan(D_states[2]))
+    for state in [0, 1, 3]:
+        exp_rdc, D_av = nmr.calculate_rdc(traj[dtrajs == state], RDC_inp_file, minimize_rmsd=False)
+        assert np.allclose(D_states[state], D_av)
+
+    exp_rdc, D_joint, populations, A_joint = nmr.calculate_rdc_states('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                                      RDC_inp_file, dtrajs)
+    exp_rdc, D_av = nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False)
+    assert np.allclose(np.nansum(populations[:, None]*D_joint, axis=0), D_av)
+
+
+def test_rdc_cross_validation():
+    """
+    Closed-form cross-validation should match explicit refits without left-out RDCs
+    """
+    exp_rdc, F_blocks, block_frames = nmr.calculate_rdc_blocks('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                               'test1/experimental_data.txt', block_size=25)
+    F_av = F_blocks/block_frames[:, None, None]
+    for n_folds in [None, 4]:
+        Q_free, D_free = nmr.rdc_cross_validation(exp_rdc, F_av, n_folds=n_folds, seed=3)
+        assert Q_free.shape == (4,)
+        folds = np.arange(len(exp_rdc))[:, None] if n_folds is None else \
+            np.array_split(np.random.default_rng(3).permutation(len(exp_rdc)), n_folds)
+        for block in range(4):
+            for fold in folds:
+                keep = np.setdiff1d(np.arange(len(exp_rdc)), fold)
+                A = np.linalg.lstsq(F_av[block, keep], exp_rdc[keep], rcond=-1)[0]
+                assert np.allclose(D_free[block, fold], np.dot(F_av[block, fold], A))
+        assert np.all(Q_free > nmr.rdc_q_factor(exp_rdc, nmr.fit_alignment_tensor(F_av, exp_rdc)[1]))
+    # a bond with its own tensor component is not determined by the other bonds
+    F_single = F_av[0].copy()
+    F_single[:, 4] = 0
+    F_single[0, 4] = 1
+    Q_free, D_free = nmr.rdc_cross_validation(exp_rdc, F_single)
+    assert np.isnan(Q_free) and np.isnan(D_free[0]) and np.all(np.isfinite(D_free[1:]))
+    Q_free, D_free = nmr.rdc_cross_validation(exp_rdc, F_single, n_folds=2, seed=3)
+    assert np.isnan(Q_free) and np.sum(np.isfinite(D_free)) >= len(exp_rdc)//2
+    with pytest.raises(ValueError):
+        nmr.rdc_cross_validation(exp_rdc[:8], F_av[:, :8], n_folds=2)
+
+
+def test_calculate_rdc_reweighted():
+    """
+    Maximum entropy reweighting: strong prior reproduces the plain average,
+    weaker prior improves agreement with experiment
+    """
+    RDC_inp_file = 'test1/experimental_data.txt'
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    exp_rdc, D_ref = nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False)
+    exp_rdc, D_av, weights, A, phi = nmr.calculate_rdc_reweighted('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                                  RDC_inp_file, theta=1e6, chunk_size=30,
+                                                                  n_jobs=2)
+    assert np.allclose(D_av, D_ref, atol=1e-3)
+    assert np.isclose(phi, 1.0)
+    exp_rdc, D_av, weights, A, phi = nmr.calculate_rdc_reweighted('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                                  RDC_inp_file, theta=1.0, chunk_size=30)
+    assert np.isclose(np.sum(weights), 1.0)
+    assert 0 < phi < 1
+    assert nmr.rdc_q_factor(exp_rdc, D_av) < nmr.rdc_q_factor(exp_rdc, D_ref)
+
+
+def test_calculate_s2():
+    """
+    S2 from bilinear sums should match the direct definition from second moments
+    of unit bond vectors
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    restraints = nmr.load_restraints('test1/experimental_data.txt', traj.topology)
+    S2, S2_windows = nmr.calculate_s2('test1/trajectory.xtc', 'test1/topology.pdb', restraints,
+                                      block_size=20, window=2, chunk_size=30, n_jobs=2)
+
+    def s2_direct(xyz):
+        u = nmr.vector_chunk(restraints.bond_selections, xyz)
+        moments = np.einsum('fba,fbc->bac', u, u)/xyz.shape[0]
+        return 1.5*np.sum(moments**2, axis=(1, 2)) - 0.5
+
+    assert np.allclose(S2, s2_direct(traj.xyz))
+    assert S2_windows.shape == (4, len(restraints))
+    for i in range(4):
+        assert np.allclose(S2_windows[i], s2_direct(traj.xyz[20*i:20*i+40]))
+
+
+def test_calculate_noe(tmp_path):
+    """
+    Streaming <r^-6> and <r^-3> distances, with an atom group, weights and blocks
+    """
+    restraint_file = tmp_path / 'noe.txt'
+    restraint_file.write_text("    2    GLN      H     3    ILE      H     1.8     3.0\n"
+                              "    3    ILE     HA     4    PHE      H     1.8     5.0\n"
+                              "    2    GLN    HB#     3    ILE      H     1.8     6.0\n")
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    top = traj.topology
+    pairs = [[top.select('resid 1 and name H')[0], top.select('resid 2 and name H')[0]],
+             [top.select('resid 2 and name HA')[0], top.select('resid 3 and name H')[0]]]
+    groups = [[pair] for pair in pairs] + [[[i, top.select('resid 2 and name H')[0]]
+                                            for i in top.select('resid 1 and name HB2 HB3')]]
+    weights = np.linspace(1, 2, 100)
+    r6_ref = []
+    r3_ref = []
+    for group in groups:
+        r6_frame = np.sum((10*md.compute_distances(traj, group, periodic=False))**-6.0, axis=1)
+        r6_ref.append(np.average(r6_frame, weights=weights)**(-1.0/6))
+        r3_ref.append(np.average(r6_frame**0.5, weights=weights)**(-1.0/3))
+
+    r6, r3, violations = md_noe.calculate_noe('test1/trajectory.xtc', 'test1/topology.pdb', str(restraint_file),
+                                              chunk_size=30, n_jobs=2, weights=weights)
+    assert np.allclose(r6, r6_ref, rtol=1e-5)
+    assert np.allclose(r3, r3_ref, rtol=1e-5)
+    restraints = md_noe.DistanceRestraintSet(str(restraint_file), top)
+    assert np.allclose(violations, np.maximum(r6 - restraints.upper, 0) - np.maximum(restraints.lower - r6, 0))
+    assert violations[0] != 0
+
+    restraints, R_blocks, block_frames = md_noe.calculate_noe_blocks('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                                     restraints, block_size=25, chunk_size=30)
+    assert R_blocks.shape == (4, 3, 2)
+    r6_all, r3_all = md_noe.noe_distances(np.sum(R_blocks, axis=0)/np.sum(block_frames))
+    r6_uniform, r3_uniform, violations = md_noe.calculate_noe('test1/trajectory.xtc', 'test1/topology.pdb',
+                                                              restraints)
+    assert np.allclose(r6_all, r6_uniform)
+
+
+def test_calculate_j3():
+    """
+    Streaming 3J couplings should match md.compute_J3_HN_HA and index2res
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    weights = np.linspace(1, 2, 100)
+    residue_index, residue_name, J_av, J_std = nmr.calculate_j3(['test1/trajectory.xtc', 'test1/trajectory.xtc'],
+                                                                 'test1/topology.pdb', chunk_size=30, n_jobs=2,
+                                                                 weights=np.concatenate((weights, weights)))
+    indices, J = md.compute_J3_HN_HA(traj)
+    assert (residue_index, residue_name) == analysis.index2res(traj[0])
+    assert np.allclose(J_av, np.average(J, axis=0, weights=weights))
+    assert np.allclose(J_std, np.sqrt(np.average((J - J_av)**2, axis=0, weights=weights)), atol=1e-5)
+
+
+def test_calculate_rdc_checkpoints():
+    """
+    Cumulative and sliding-window estimates at checkpoints should match fits to
+    the corresponding frame ranges
+    """
+    RDC_inp_file = 'test1/experimental_data.txt'
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    checkpoints = [10, 37, 64, 100]
+    for window in [None, 30]:
+        exp_rdc, Q, A = nmr.calculate_rdc_checkpoints('test1/trajectory.xtc', 'test1/topology.pdb', RDC_inp_file,
+                                                      checkpoints, window=window, chunk_size=16, n_jobs=3)
+        for c, Q_c in zip(checkpoints, Q):
+            start = 0 if window is None else max(c - window, 0)
+            exp_rdc, D_av = nmr.calculate_rdc(traj[start:c], RDC_inp_file, minimize_rmsd=False)
+            assert np.isclose(Q_c, nmr.rdc_q_factor(exp_rdc, D_av))
+    for checkpoints, window in [([0, 50], None), ([64, 37], None), ([37, 37], None), ([10, 50], 0)]:
+        with pytest.raises(ValueError):
+            nmr.calculate_rdc_checkpoints('test1/trajectory.xtc', 'test1/topology.pdb', RDC_inp_file,
+                                          checkpoints, window=window)
+
+
+def test_nmr_engine():
+    """
+    In-memory trajectories, trajectory files and md_nmr wrappers go through the same engine
+    """
+    RDC_inp_file = 'test1/experimental_data.txt'
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    engine = nmr.NMREngine('test1/topology.pdb', chunk_size=30, n_jobs=2)
+    exp_rdc, D_file = engine.rdc('test1/trajectory.xtc', RDC_inp_file, mode='full')
+    exp_rdc, D_memory = engine.rdc(traj, RDC_inp_file, mode='full')
+    assert D_memory.shape == (100, len(exp_rdc))
+    assert np.allclose(D_file, D_memory, atol=1e-4)
+    assert sum(chunk.n_frames for chunk in engine.frames(['test1/trajectory.xtc']*2)) == 200
+
+    # weights and microstate labels of both kinds of input are checked by the same chunk loop
+    for traj_input in [traj, 'test1/trajectory.xtc']:
+        for n in [50, 150]:
+            with pytest.raises(ValueError, match="Number of weights"):
+                engine.rdc(traj_input, RDC_inp_file, weights=np.ones(n))
+            with pytest.raises(ValueError, match="Number of microstate labels"):
+                nmr.calculate_rdc_states(traj_input, 'test1/topology.pdb', RDC_inp_file, np.zeros(n, dtype=int),
+                                         n_states=2)
+    with pytest.raises(ValueError, match="Number of weights"):
+        nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False, weights=np.ones(150))
+    indices, residue_index, J_memory, J_std = nmr.calculate_j3(traj, 'test1/topology.pdb', chunk_size=30)
+    indices, residue_index, J_file, J_std = nmr.calculate_j3('test1/trajectory.xtc', 'test1/topology.pdb')
+    assert np.allclose(J_memory, J_file, atol=1e-4)
+
+    exp_rdc, D_av = nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False)
+    exp_old, D_old = md_nmr.calculate_rdc(traj, RDC_inp_file, minimize_rmsd=False)
+    assert np.allclose(D_old, D_av)
+    exp_old, D_old = md_nmr.calculate_rdc_large('test1/trajectory.xtc', 'test1/topology.pdb', RDC_inp_file,
+                                                minimize_rmsd=False)
+    assert np.allclose(D_old, D_av, atol=1e-4)
+
+
+def test_superpose2():
+    """
+    Row-wise medoid superposition should reproduce superpose, also as default of calculate_rdc
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')[::2]
+    reference = superimpose.superpose(traj[:])
+    alpha = traj.atom_slice(superimpose.alpha_indices(traj.topology))
+    min_idx, sum_RMSD = superimpose.find_medoid(alpha)
+    min_idx_parallel, sum_RMSD_parallel = superimpose.find_medoid(alpha, n_jobs=3)
+    assert min_idx == min_idx_parallel
+    assert np.allclose(sum_RMSD, sum_RMSD_parallel)
+    assert np.allclose(superimpose.superpose2(traj[:], n_jobs=2).xyz, reference.xyz)
+
+    exp_rdc, D_av = nmr.calculate_rdc(traj[:], 'test1/experimental_data.txt', minimize_rmsd=True)
+    exp_rdc, D_reference = nmr.calculate_rdc(reference, 'test1/experimental_data.txt', minimize_rmsd=False)
+    assert np.allclose(D_av, D_reference)
+
+
+def test_approximate_medoid(capsys):
+    """
+    Pruned medoid search should find the exact medoid with fewer RMSD evaluations,
+    its error bound and number of evaluations are reported to callers
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    alpha = traj.atom_slice(superimpose.alpha_indices(traj.topology))
+    rng = np.random.default_rng(1)
+    xyz = alpha.xyz[0] + np.cumsum(rng.normal(scale=0.01, size=(500,) + alpha.xyz.shape[1:]), axis=0)
+    drift = md.Trajectory(xyz.astype(np.float32), alpha.topology)
+    min_idx, sum_RMSD = superimpose.find_medoid(drift)
+    approx_idx, min_sum, error_bound, n_evaluations = superimpose.approximate_medoid(drift, seed=0)
+    assert approx_idx == min_idx
+    assert np.isclose(min_sum, sum_RMSD[min_idx])
+    assert error_bound == 0.0
+    assert n_evaluations < 500*500
+
+    approx_idx, min_sum, error_bound, n_evaluations = superimpose.approximate_medoid(drift, n_candidates=50,
+                                                                                     tol=0.1, seed=0)
+    assert np.isclose(min_sum, sum_RMSD[approx_idx])
+    assert error_bound >= 0.0
+    assert n_evaluations <= 50*500
+    traj_approximate, error_bound, n_evaluations = superimpose.superpose2(traj[:], approximate=True, seed=0)
+    assert np.allclose(traj_approximate.xyz, superimpose.superpose2(traj[:]).xyz)
+    assert error_bound == 0.0 and 0 < n_evaluations <= traj.n_frames**2
+    exp_rdc, D_approximate = nmr.calculate_rdc(traj[:], 'test1/experimental_data.txt', approximate_medoid=True, seed=0)
+    assert 'Approximate medoid: error bound' in capsys.readouterr().out
+    assert np.allclose(D_approximate, nmr.calculate_rdc(traj[:], 'test1/experimental_data.txt')[1])
+
+
+def test_superpose_large(tmp_path):
+    """
+    Out-of-core superposition should match in-memory superposition on the same reference frame
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    keep = superimpose.alpha_indices(traj.topology)
+    for output_file in [str(tmp_path / 'aligned.xtc'), str(tmp_path / 'aligned.dcd')]:
+        frame_index, n_frames = superimpose.superpose_large(['test1/trajectory.xtc']*2, 'test1/topology.pdb',
+                                                            output_file, n_samples=40, chunk_size=30, seed=2)
+        assert n_frames == 200
+        aligned = md.load(output_file, top='test1/topology.pdb')
+        reference = traj[frame_index % 100]
+        expected = traj[:].superpose(reference, 0, atom_indices=keep)
+        assert aligned.n_frames == 200
+        assert np.allclose(aligned.xyz[100:], expected.xyz, atol=2e-3)
+
+
+def test_pairwise_rmsd(tmp_path):
+    """
+    Condensed RMSD matrix in parallel, cached on disk and reused for the medoid search
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    keep = superimpose.alpha_indices(traj.topology)
+    condensed = superimpose.pairwise_rmsd(traj, n_jobs=3)
+    assert condensed.shape == (100*99//2,)
+    assert np.isclose(condensed[0], md.rmsd(traj[1], traj[0], atom_indices=keep)[0], atol=1e-5)
+    assert np.isclose(condensed[99 + 5], md.rmsd(traj[7], traj[1], atom_indices=keep)[0], atol=1e-5)
+    assert np.allclose(condensed, superimpose.pairwise_rmsd(traj))
+
+    cached = superimpose.pairwise_rmsd(traj, n_jobs=2, cache_dir=str(tmp_path))
+    assert np.allclose(cached, condensed)
+    assert len(list(tmp_path.iterdir())) == 1
+    assert isinstance(superimpose.pairwise_rmsd(traj, cache_dir=str(tmp_path)), np.memmap)
+
+    alpha = traj.atom_slice(keep)
+    min_idx, sum_RMSD = superimpose.find_medoid(alpha)
+    min_idx_cached, sum_RMSD_cached = superimpose.find_medoid(alpha, cache_dir=str(tmp_path))
+    assert min_idx_cached == min_idx
+    assert np.allclose(sum_RMSD_cached, sum_RMSD, atol=1e-3)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_superpose_mean(tmp_path):
+    """
+    Iterative mean structure in memory and streamed from files
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    keep = superimpose.alpha_indices(traj.topology)
+    aligned, mean = superimpose.superpose_mean(traj[:])
+    # the mean structure is a fixed point: mean of frames aligned on it
+    assert np.allclose(np.mean(aligned.xyz[:, keep], axis=0), mean.xyz[0], atol=1e-4)
+
+    mean_large, n_iter = superimpose.mean_structure_large(['test1/trajectory.xtc']*2, 'test1/topology.pdb',
+                                                          chunk_size=30)
+    assert n_iter > 1
+    assert np.allclose(mean_large.xyz, mean.xyz, atol=1e-5)
+
+    output_file = str(tmp_path / 'aligned.xtc')
+    frame_index, n_frames = superimpose.superpose_large('test1/trajectory.xtc', 'test1/topology.pdb', output_file,
+                                                        method='mean', chunk_size=30)
+    assert frame_index is None and n_frames == 100
+    assert np.allclose(md.load(output_file, top='test1/topology.pdb').xyz, aligned.xyz, atol=2e-3)
+
+
+def test_superpose_replicas(tmp_path):
+    """
+    Batch superposition of replicas on a shared reference
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    keep = superimpose.alpha_indices(traj.topology)
+    replicas = []
+    for i, frames in enumerate([slice(0, 40), slice(40, 100)]):
+        replicas.append(str(tmp_path / ('replica_%i.xtc' % i)))
+        traj[frames].save_xtc(replicas[-1])
+    summary_file = str(tmp_path / 'summary.txt')
+    reference, rmsd, summary = superimpose.superpose_replicas(replicas, 'test1/topology.pdb', reference=(1, 5),
+                                                              chunk_size=16, n_jobs=2, summary_file=summary_file)
+    assert np.allclose(reference.xyz, traj.xyz[45:46, keep], atol=1e-3)
+    expected = traj[:].superpose(traj, 45, atom_indices=keep)
+    aligned = md.load(str(tmp_path / 'replica_1_aligned.xtc'), top='test1/topology.pdb')
+    assert np.allclose(aligned.xyz, expected.xyz[40:], atol=2e-3)
+    assert np.allclose(np.concatenate(rmsd), md.rmsd(traj, traj, 45, atom_indices=keep), atol=1e-3)
+    assert summary.shape == (2, 6)
+    assert np.allclose(summary[:, 0], [40, 60])
+    assert np.isclose(summary[1, 3], 0, atol=1e-3)
+    assert np.loadtxt(summary_file, usecols=range(6)).shape == (2, 6)
+
+    reference, rmsd, summary = superimpose.superpose_replicas(replicas, 'test1/topology.pdb', n_samples=50,
+                                                              chunk_size=16, seed=0)
+    assert np.all(summary[:, 1] > 0)
+
+
+def test_RMSD1to1(tmp_path):
+    """
+    Vectorized and streaming frame-paired RMSD should match md.rmsd of each pair
+    """
+    traj = md.load('test1/trajectory.xtc', top='test1/topology.pdb')
+    shifted = traj[1:].join(traj[0])
+    expected = np.array([md.rmsd(shifted[i], traj[i])[0] for i in range(traj.n_frames)])
+    assert np.allclose(analysis.RMSD1to1(traj, shifted), expected, atol=1e-5)
+    assert np.allclose(analysis.paired_rmsd(traj.xyz, traj.xyz), 0, atol=1e-5)
+
+    shifted_file = str(tmp_path / 'shifted.xtc')
+    shifted.save_xtc(shifted_file)
+    rmsd = analysis.RMSD1to1_large('test1/trajectory.xtc', shifted_file, 'test1/topology.pdb', chunk_size=30)
+    assert np.allclose(rmsd, expected, atol=1e-3)
+    keep = superimpose.alpha_indices(traj.topology)
+    rmsd = analysis.RMSD1to1_large('test1/trajectory.xtc', shifted_file, 'test1/topology.pdb', chunk_size=30,
+                                   atom_indices1=keep, atom_indices2=keep)
+    assert np.allclose(rmsd, [md.rmsd(shifted[i], traj[i], atom_indices=keep)[0] for i in range(100)], atol=1e-3)
+
+    shifted[:50].save_xtc(shifted_file)
+    with pytest.raises(IOError):
+        analysis.RMSD1to1_large('test1/trajectory.xtc', shifted_file, 'test1/topology.pdb', chunk_size=30)